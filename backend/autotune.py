@@ -0,0 +1,150 @@
+# Sweep worker processes x intra-op x inter-op x OpenCV threads on this host and record the best point
+#
+#   python autotune.py --output runtime_profile.json
+#   RESPIRASCAN_RUNTIME_PROFILE=runtime_profile.json gunicorn -c gunicorn.conf.py server:app
+#
+# Every setting runs in fresh processes (torch fixes the inter-op pool at first use). All workers of
+# a setting load the model, then score synthetic X-rays (decode-free preprocess + forward) together
+# for --seconds, each pinned to its own slice of cores when there is more than one.
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from utils.runtime_utils import available_cpus, worker_cpus
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+PROBE = """
+import json, sys, time
+from utils.runtime_utils import configure_runtime
+config, model_path, batch_size, image_size, seconds = json.loads(sys.argv[1])
+info = configure_runtime(**config)
+
+from utils.model_utils import MultiTaskDenseNet, fast_preprocess, load_model, predict_batch
+from benchmark import synthetic_xray
+model = load_model(model_path) if model_path else MultiTaskDenseNet().eval()
+image = synthetic_xray(image_size)
+
+def step():
+    predict_batch([fast_preprocess(image) for _ in range(batch_size)], model, batch_size=batch_size)
+
+step()
+step()
+print("ready", flush=True)
+sys.stdin.readline()
+
+latencies = []
+end = time.perf_counter() + seconds
+while time.perf_counter() < end:
+    start = time.perf_counter()
+    step()
+    latencies.append(time.perf_counter() - start)
+print(json.dumps({"latencies": latencies, "runtime": info}), flush=True)
+"""
+
+
+def powers_of_two(limit):
+    return [2 ** i for i in range(limit.bit_length()) if 2 ** i <= limit]
+
+
+# Default grid: 1, 2, 4... workers, each with its share of the cores or half of it
+def default_grid(cpus, args):
+    grid = []
+    for workers in args.workers or powers_of_two(cpus):
+        share = max(1, cpus // workers)
+        intra_options = args.intra_op_threads or sorted({share, max(1, share // 2)})
+        for intra, inter, cv2_threads in itertools.product(intra_options, args.inter_op_threads, args.cv2_threads):
+            grid.append({"workers": workers, "intra_op_threads": intra,
+                         "inter_op_threads": inter, "cv2_threads": cv2_threads})
+    return grid
+
+
+def run_setting(setting, cpus, args):
+    workers = setting["workers"]
+    pin = workers > 1 and not args.no_pin
+    processes = []
+    for index in range(workers):
+        config = {key: setting[key] for key in ("intra_op_threads", "inter_op_threads", "cv2_threads")}
+        if pin:
+            config["cpu_affinity"] = worker_cpus(index, workers, cpus)
+        probe_args = json.dumps([config, args.model, args.batch_size, args.image_size, args.seconds])
+        processes.append(subprocess.Popen([sys.executable, "-c", PROBE, probe_args], cwd=BASE_DIR, text=True,
+                                          stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL))
+
+    # Start measuring only once every worker has loaded and warmed up
+    for process in processes:
+        if process.stdout.readline().strip() != "ready":
+            raise RuntimeError(f"probe failed for {setting}")
+    for process in processes:
+        process.stdin.write("go\n")
+        process.stdin.flush()
+
+    latencies = []
+    for process in processes:
+        output, _ = process.communicate()
+        latencies.extend(json.loads(output.strip().splitlines()[-1])["latencies"])
+
+    ordered = sorted(latencies)
+    return dict(setting, pin=pin,
+                images_per_s=len(latencies) * args.batch_size / args.seconds,
+                p50_ms=1000 * statistics.median(ordered),
+                p99_ms=1000 * ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))])
+
+
+def main():
+    cpus = available_cpus()
+
+    parser = argparse.ArgumentParser(description="Tune worker and thread counts for this host")
+    parser.add_argument("--model", help="Checkpoint (.pth); random weights if omitted")
+    parser.add_argument("--workers", nargs="+", type=int, help="Worker process counts (default 1, 2, 4... up to the cores)")
+    parser.add_argument("--intra-op-threads", nargs="+", type=int, help="Default: each worker's share of the cores and half of it")
+    parser.add_argument("--inter-op-threads", nargs="+", type=int, default=[1, 2])
+    parser.add_argument("--cv2-threads", nargs="+", type=int, default=[1])
+    parser.add_argument("--batch-size", type=int, default=1, help="Images per forward pass in each worker")
+    parser.add_argument("--image-size", type=int, default=1024)
+    parser.add_argument("--seconds", type=float, default=5.0, help="Measurement time per setting")
+    parser.add_argument("--objective", choices=["throughput", "latency"], default="throughput")
+    parser.add_argument("--no-pin", action="store_true", help="Do not pin workers to separate cores")
+    parser.add_argument("--output", default=os.path.join(BASE_DIR, 'runtime_profile.json'))
+    args = parser.parse_args()
+
+    results = []
+    for setting in default_grid(len(cpus), args):
+        print(f"workers {setting['workers']:>2}  intra {setting['intra_op_threads']:>2}  "
+              f"inter {setting['inter_op_threads']:>2}  cv2 {setting['cv2_threads']:>2} ...", end="", flush=True)
+        result = run_setting(setting, cpus, args)
+        print(f"  {result['images_per_s']:7.1f} img/s  p50 {result['p50_ms']:7.1f} ms  p99 {result['p99_ms']:7.1f} ms")
+        results.append(result)
+
+    best_throughput = max(results, key=lambda r: r["images_per_s"])
+    best_latency = min(results, key=lambda r: r["p50_ms"])
+    best = best_throughput if args.objective == "throughput" else best_latency
+
+    profile = {
+        "host": {"cpus": len(cpus), "machine": platform.machine(), "python": platform.python_version(),
+                 "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "objective": args.objective,
+        "batch_size": args.batch_size,
+        "best": best,
+        "best_throughput": best_throughput,
+        "best_latency": best_latency,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(profile, f, indent=2)
+
+    print(f"\nbest ({args.objective}): {best['workers']} worker(s) x {best['intra_op_threads']} intra-op, "
+          f"{best['inter_op_threads']} inter-op, {best['cv2_threads']} cv2 thread(s), "
+          f"{best['images_per_s']:.1f} img/s, p50 {best['p50_ms']:.1f} ms")
+    print(f"written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+# Inference and explanation benchmarks on synthetic X-ray-sized inputs with randomly
+# initialised MultiTaskDenseNet weights, so no checkpoint or network is needed.
+#
+#   python benchmark.py --output results.json                 # run and compare against the baseline
+#   python benchmark.py --output results.json --save-baseline # record this host's baseline
+#
+# Metric names end in _ms or _mb (lower is better) or _per_s (higher is better);
+# anything worse than the baseline by more than --tolerance is flagged as a regression.
+# The leak case's trends are checked against fixed limits instead (see check_leak).
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+
+from utils.cache_utils import encode_image, image_formats, preview_image
+from utils.model_utils import (Explanation, GradCAM, MultiTaskDenseNet, analyze_image, apply_gradcam,
+                               fast_preprocess, get_gradcam, gradcam_target_layer, predict_batch, predict_image,
+                               preprocess)
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+DEFAULT_BASELINE = os.path.join(BASE_DIR, 'benchmark_baseline.json')
+CASES = ("latency", "preprocess", "batch", "threads", "load", "payload", "leak", "channels")
+
+
+# Deterministic greyscale "X-ray": smooth anatomy-like structure plus noise
+def synthetic_xray(size=2048, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    body = np.exp(-((x - 0.5) ** 2 / 0.08 + (y - 0.55) ** 2 / 0.12))
+    lungs = np.exp(-((np.abs(x - 0.5) - 0.18) ** 2 / 0.008 + (y - 0.45) ** 2 / 0.05))
+    pixels = 200 * body - 90 * lungs + rng.normal(0, 6, (size, size))
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'L')
+
+
+def time_calls(fn, repeats, warmup):
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def percentiles(prefix, timings):
+    ordered = sorted(timings)
+
+    def pick(q):
+        return 1000 * ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {f"{prefix}.p50_ms": pick(0.5), f"{prefix}.p90_ms": pick(0.9), f"{prefix}.p99_ms": pick(0.99)}
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+
+
+# Resident (not peak) memory, so it can go down as well as up; the peak where /proc is missing
+def current_rss_mb():
+    if not os.path.exists("/proc/self/statm"):
+        return peak_rss_mb()
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def bench_latency(model, image, args):
+    results = {}
+    for name, fn in [
+        ("predict_image", lambda: predict_image(image, model)),
+        ("apply_gradcam", lambda: apply_gradcam(image, model)),
+        ("analyze_image", lambda: analyze_image(image, model)),
+        ("analyze_image_cam", lambda: analyze_image(image, model, explain_mode="cam")),
+    ]:
+        results.update(percentiles(f"latency.{name}", time_calls(fn, args.repeats, args.warmup)))
+    return results
+
+
+def bench_preprocess(model, image, args):
+    rgb = image.convert('RGB')
+    results = {}
+    results.update(percentiles("preprocess.reference", time_calls(lambda: preprocess(rgb), args.repeats, 1)))
+    results.update(percentiles("preprocess.fast", time_calls(lambda: fast_preprocess(image), args.repeats, 1)))
+    return results
+
+
+def bench_batch(model, image, args):
+    results = {}
+    sample = fast_preprocess(image)
+    for batch_size in args.batch_sizes:
+        inputs = sample.expand(batch_size, -1, -1, -1).contiguous()
+        timings = time_calls(lambda: predict_batch(inputs, model, batch_size=batch_size),
+                             max(1, args.repeats // 4), 1)
+        results[f"batch.{batch_size}.images_per_s"] = batch_size / statistics.median(timings)
+    return results
+
+
+def bench_threads(model, image, args):
+    results = {}
+    original = torch.get_num_threads()
+    try:
+        for threads in args.threads:
+            torch.set_num_threads(threads)
+            timings = time_calls(lambda: predict_image(image, model), max(3, args.repeats // 2), 1)
+            results[f"threads.{threads}.predict_image.p50_ms"] = 1000 * statistics.median(timings)
+    finally:
+        torch.set_num_threads(original)
+    return results
+
+
+# Cold start in a fresh process: load time plus private (anonymous) vs file-backed RSS after one
+# forward pass. File-backed pages of a memory-mapped checkpoint are shared between workers.
+LOAD_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from utils.model_utils import load_model, warmup_model
+model = load_model(sys.argv[1], mmap=sys.argv[2] == "1")
+loaded = time.perf_counter()
+warmup_model(model, 1)
+status = dict(line.split(":", 1) for line in open("/proc/self/status"))
+print(json.dumps({"import_load_ms": 1000 * (loaded - start),
+                  "rss_anon_kb": int(status["RssAnon"].split()[0]), "rss_file_kb": int(status["RssFile"].split()[0])}))
+"""
+
+
+def bench_load(model, image, args):
+    results = {}
+    if not os.path.exists("/proc/self/status"):
+        return results  # RssAnon/RssFile are Linux-only
+
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = os.path.join(tmp, "model.pth")
+        torch.save(model.state_dict(), checkpoint)
+        for label, flag in [("regular", "0"), ("mmap", "1")]:
+            output = subprocess.run([sys.executable, "-c", LOAD_PROBE, checkpoint, flag], cwd=BASE_DIR,
+                                    capture_output=True, text=True, check=True).stdout
+            probe = json.loads(output.strip().splitlines()[-1])
+            results[f"load.{label}.import_load_ms"] = probe["import_load_ms"]
+            results[f"load.{label}.rss_private_mb"] = probe["rss_anon_kb"] / 1024
+            results[f"load.{label}.rss_shared_file_mb"] = probe["rss_file_kb"] / 1024
+    return results
+
+
+# Bytes sent to the browser per scan (the upload plus three heatmaps) and the server time spent
+# encoding them. "pil" is what st.image does with PIL images and PNG bytes on every rerun: the upload
+# is encoded as JPEG quality 100, then shrunk to its 1460 px limit and re-encoded at quality 90, and
+# PNG heatmaps are re-encoded as JPEG quality 90. "preview" sends a 1024 px JPEG preview and JPEG
+# heatmaps, which st.image passes through. The api.* sizes are one /explain heatmap per format.
+def bench_payload(model, image, args):
+    with Explanation(image, model, "cam") as explanation:
+        heatmaps = list(explanation.heatmaps().values())
+        cams = list(explanation.cams().values())
+
+    def st_reencode(data, quality=90, max_width=1460):
+        decoded = Image.open(io.BytesIO(data))
+        if decoded.width > max_width:
+            decoded = decoded.resize((max_width, int(decoded.height * max_width / decoded.width)), Image.BILINEAR)
+        return encode_image(decoded, 'JPEG', quality)
+
+    def pil_path():
+        upload = st_reencode(encode_image(image, 'JPEG', 100))
+        return [upload] + [st_reencode(encode_image(heatmap)) for heatmap in heatmaps]
+
+    def preview_path():
+        # Heatmaps are encoded once on the explanation workers; the preview once per image
+        return [encode_image(preview_image(image), *image_formats["jpeg"])] + \
+            [encode_image(heatmap, *image_formats["jpeg"]) for heatmap in heatmaps]
+
+    results = {}
+    for label, fn in [("pil", pil_path), ("preview", preview_path)]:
+        timings = time_calls(fn, max(3, args.repeats // 4), 1)
+        results[f"payload.{label}.encode_ms"] = 1000 * statistics.median(timings)
+        results[f"payload.{label}.sent_kb"] = sum(len(data) for data in fn()) / 1024
+    for name, (image_format, quality) in image_formats.items():
+        results[f"payload.api.heatmap_{name}_kb"] = len(encode_image(heatmaps[0], image_format, quality)) / 1024
+    results["payload.api.cam_kb"] = cams[0].nbytes / 1024
+    return results
+
+
+# Repeated Grad-CAM on one model. First, rounds of 8 threads released together asking a model
+# without an explainer for one (with a short switch interval to provoke the race): afterwards the
+# target layer must hold one explainer's hooks. Then --leak-calls sequential apply_gradcam calls,
+# with the least-squares growth of resident memory and latency per 1,000 calls, skipping the first
+# tenth as warm-up.
+def bench_leak(model, image, args):
+    fresh = MultiTaskDenseNet().eval()
+    fresh.load_state_dict(model.state_dict())
+    layer = gradcam_target_layer(fresh)
+    barrier = threading.Barrier(8)
+
+    def first_call(_):
+        barrier.wait()
+        return get_gradcam(fresh)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(8) as pool:
+            for _ in range(200):
+                if hasattr(fresh, '_gradcam'):
+                    fresh._gradcam.remove_hooks()
+                    del fresh._gradcam
+                list(pool.map(first_call, range(8)))
+    finally:
+        sys.setswitchinterval(interval)
+    results = {"leak.explainer_hooks": len(get_gradcam(fresh)._handles),
+               "leak.target_layer_hooks": len(layer._forward_hooks) + len(layer._backward_hooks)}
+
+    timings, rss = [], []
+    for _ in range(args.leak_calls):
+        start = time.perf_counter()
+        apply_gradcam(image, fresh)
+        timings.append(1000 * (time.perf_counter() - start))
+        rss.append(current_rss_mb())
+
+    skip = args.leak_calls // 10
+    calls = np.arange(skip, args.leak_calls)
+    results["leak.rss_slope_mb_per_1k"] = 1000 * np.polyfit(calls, rss[skip:], 1)[0]
+    results["leak.latency_slope_ms_per_1k"] = 1000 * np.polyfit(calls, timings[skip:], 1)[0]
+    results["leak.apply_gradcam.p50_ms"] = statistics.median(timings[skip:])
+    return results
+
+
+# Absolute limits for the leak case: no extra hooks, under 16 MB and 10% of the median latency of
+# growth per 1,000 calls. Returns (metric, limit, value) for each one exceeded.
+def check_leak(results):
+    if "leak.target_layer_hooks" not in results:
+        return []
+    limits = {
+        "leak.target_layer_hooks": results["leak.explainer_hooks"],
+        "leak.rss_slope_mb_per_1k": 16,
+        "leak.latency_slope_ms_per_1k": 0.1 * results["leak.apply_gradcam.p50_ms"],
+    }
+    return [(key, limit, results[key]) for key, limit in limits.items() if results[key] > limit]
+
+
+# The per-channel NumPy loop Grad-CAM maps were once built with, as the channels case's reference
+def loop_cams(gradients, activations, size=224):
+    cams = []
+    for gradient in gradients.numpy():
+        weights = np.mean(gradient, axis=(1, 2))
+        cam = np.zeros(activations.shape[1:], dtype=np.float32)
+        for i, w in enumerate(weights):
+            cam += w * activations[i].numpy()
+        cam = cv2.resize(np.maximum(cam, 0), (size, size))
+        cam -= cam.min()
+        cam /= cam.max() if cam.max() > 0 else 1
+        cams.append(cam)
+    return cams
+
+
+# Cost of turning three heads' gradients and a 14x14 activation map into 224x224 Grad-CAM maps as
+# the channel count grows (DenseNet121's target layer has 32, its final feature map 1024): the
+# reference loop grows with it, the vectorized GradCAM._compute_cams should stay close to flat.
+def bench_channels(model, image, args):
+    gradcam = GradCAM(nn.Identity(), nn.Identity())
+    gradcam.remove_hooks()
+    rng = np.random.default_rng(0)
+    results = {}
+    for channels in args.channels:
+        gradients = torch.from_numpy(rng.normal(size=(3, channels, 14, 14)).astype(np.float32))
+        activations = torch.from_numpy(rng.random((channels, 14, 14), dtype=np.float32))
+        for label, fn in [("loop", lambda: loop_cams(gradients, activations)),
+                          ("vectorized", lambda: gradcam._compute_cams(gradients, activations))]:
+            timings = time_calls(fn, args.repeats, 1)
+            results[f"channels.{channels}.{label}_ms"] = 1000 * statistics.median(timings)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, value in results.items():
+        if key.startswith("leak.") and key != "leak.apply_gradcam.p50_ms":
+            continue
+        reference = baseline.get(key)
+        if reference is None or not reference:
+            continue
+        change = (value - reference) / reference
+        if key.endswith("_per_s"):
+            change = -change
+        if change > tolerance:
+            regressions.append((key, reference, value, change))
+    return regressions
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    default_threads = sorted({1, 2, 4, 8, 16, cpu_count} & set(range(1, cpu_count + 1)))
+
+    parser = argparse.ArgumentParser(description="RespiraScan inference benchmarks")
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=list(CASES))
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--image-size", type=int, default=2048)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--threads", nargs="+", type=int, default=default_threads)
+    parser.add_argument("--leak-calls", type=int, default=1000, help="Sequential calls of the leak case")
+    parser.add_argument("--channels", nargs="+", type=int, default=[32, 128, 512, 1024, 2048],
+                        help="Channel counts of the channels case")
+    parser.add_argument("--output", help="Write results JSON here")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative slowdown")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = MultiTaskDenseNet().eval()
+    image = synthetic_xray(args.image_size)
+
+    benches = {"latency": bench_latency, "preprocess": bench_preprocess,
+               "batch": bench_batch, "threads": bench_threads, "load": bench_load, "payload": bench_payload,
+               "leak": bench_leak, "channels": bench_channels}
+    results = {}
+    for case in args.cases:
+        print(f"running {case}...", file=sys.stderr)
+        results.update(benches[case](model, image, args))
+        results[f"rss.after_{case}_mb"] = peak_rss_mb()
+    results["rss.peak_mb"] = peak_rss_mb()
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpu_count": cpu_count,
+            "torch_threads": torch.get_num_threads(),
+            "machine": platform.machine(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+    for key, value in results.items():
+        print(f"{key:<45} {value:10.2f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    leaks = check_leak(results)
+    if leaks:
+        print(f"\n{len(leaks)} leak check(s) failed:")
+        for key, limit, value in leaks:
+            print(f"  {key:<45} {value:10.2f} > {limit:10.2f}")
+        sys.exit(1)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}; run with --save-baseline to create one")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["meta"].get("cpu_count") != cpu_count or baseline["meta"].get("torch") != torch.__version__:
+        print("warning: baseline was recorded on a different host or torch version")
+
+    regressions = compare(results, baseline["results"], args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+        for key, reference, value, change in regressions:
+            print(f"  {key:<45} {reference:10.2f} -> {value:10.2f} ({change:+.0%})")
+        sys.exit(1)
+    print("\nno regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# Decode time, peak memory and prediction parity of native DICOM input (needs pydicom)
+#
+#   python dicom_report.py --size 4096 --json dicom.json
+#
+# Writes synthetic 16-bit chest X-ray DICOM files (uncompressed MONOCHROME2 and MONOCHROME1,
+# JPEG 2000 lossless, 8-bit JPEG baseline) to a temporary folder and loads each one with
+# load_image, as predict_image, scan.py and the server do, and with draft=True. The reference is
+# the convert-first workflow: full-resolution pixel_array, windowed to 8 bits, written as PNG and
+# loaded again. Peak memory is the largest Python/numpy heap use during the load (tracemalloc);
+# pages of a memory-mapped file are not counted, as they are not copied.
+
+import argparse
+import io
+import json
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pydicom
+import torch
+from PIL import Image
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import (JPEG2000Lossless, JPEGBaseline8Bit, ExplicitVRLittleEndian, SecondaryCaptureImageStorage,
+                         generate_uid)
+
+from benchmark import synthetic_xray
+from utils.model_utils import MultiTaskDenseNet, diseases, fast_preprocess, load_image, predict_batch
+
+WINDOW = (2048, 3000)
+
+
+# 12-bit stored values in 16-bit words: the synthetic X-ray scaled up, plus fine noise
+def synthetic_pixels(size, seed=0):
+    base = np.asarray(synthetic_xray(size, seed), dtype=np.float32) * 16
+    noise = np.random.default_rng(seed).normal(0, 40, base.shape).astype(np.float32)
+    return np.clip(base + noise + 400, 0, 4095).astype(np.uint16)
+
+
+def write_dicom(path, pixels, transfer_syntax=ExplicitVRLittleEndian, photometric="MONOCHROME2"):
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = transfer_syntax
+    ds.file_meta.MediaStorageSOPClassUID = SecondaryCaptureImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.SOPClassUID = SecondaryCaptureImageStorage
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = "DX"
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = photometric
+    ds.PixelRepresentation = 0
+    if pixels.dtype == np.uint8:
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit = 8, 8, 7
+        ds.WindowCenter, ds.WindowWidth = 128, 256
+    else:
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 12, 11
+        ds.WindowCenter, ds.WindowWidth = WINDOW
+    ds.RescaleSlope, ds.RescaleIntercept = 1, 0
+
+    if transfer_syntax == JPEGBaseline8Bit:
+        frame = io.BytesIO()
+        Image.fromarray(pixels, 'L').save(frame, format="JPEG", quality=90)
+        ds.PixelData = encapsulate([frame.getvalue()])
+    elif transfer_syntax == JPEG2000Lossless:
+        frame = io.BytesIO()
+        Image.fromarray(pixels).save(frame, format="JPEG2000", no_jp2=True, irreversible=False)
+        ds.PixelData = encapsulate([frame.getvalue()])
+    else:
+        ds.PixelData = pixels.tobytes()
+    ds.save_as(path, enforce_file_format=True)
+
+
+# Convert-first reference: the whole pixel array, windowed at full resolution, PNG round trip
+def convert_first(path):
+    ds = pydicom.dcmread(path)
+    values = ds.pixel_array.astype(np.float32) * float(ds.RescaleSlope) + float(ds.RescaleIntercept)
+    center, width = float(ds.WindowCenter), float(ds.WindowWidth)
+    scaled = np.clip((values - (center - 0.5)) / (width - 1) + 0.5, 0, 1)
+    if ds.PhotometricInterpretation == "MONOCHROME1":
+        scaled = 1 - scaled
+    buffer = io.BytesIO()
+    Image.fromarray(np.rint(255 * scaled).astype(np.uint8), 'L').save(buffer, format="PNG")
+    buffer.seek(0)
+    return load_image(buffer)
+
+
+def measure(fn, repeats):
+    tracemalloc.start()
+    image = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return image, {"load_ms": 1000 * statistics.median(timings), "peak_mb": peak / 2 ** 20}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Native DICOM loading against convert-to-PNG first")
+    parser.add_argument("--size", type=int, default=4096, help="Rows and columns of the synthetic studies")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = MultiTaskDenseNet().eval()
+    pixels = synthetic_pixels(args.size)
+    cases = {
+        "native": (pixels, ExplicitVRLittleEndian, "MONOCHROME2"),
+        "native_monochrome1": (4095 - pixels, ExplicitVRLittleEndian, "MONOCHROME1"),
+        "jpeg2000": (pixels, JPEG2000Lossless, "MONOCHROME2"),
+        "jpeg_baseline": ((pixels >> 4).astype(np.uint8), JPEGBaseline8Bit, "MONOCHROME2"),
+    }
+
+    report = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, (data, transfer_syntax, photometric) in cases.items():
+            path = os.path.join(tmp, f"{name}.dcm")
+            write_dicom(path, data, transfer_syntax, photometric)
+
+            reference, reference_stats = measure(lambda: convert_first(path), args.repeats)
+            native, native_stats = measure(lambda: load_image(path), args.repeats)
+            _, draft_stats = measure(lambda: load_image(path, draft=True), args.repeats)
+            with open(path, "rb") as f:
+                upload = f.read()
+            _, upload_stats = measure(lambda: load_image(io.BytesIO(upload)), args.repeats)
+
+            inputs = [fast_preprocess(reference), fast_preprocess(native)]
+            expected, found = predict_batch(inputs, model)
+            report[name] = {
+                "file_mb": os.path.getsize(path) / 2 ** 20,
+                "decoded_size": list(native.size),
+                "convert_first": reference_stats,
+                "native": native_stats,
+                "native_draft": draft_stats,
+                "native_upload": upload_stats,
+                "input_mean_abs_diff": float((inputs[0] - inputs[1]).abs().mean()),
+                "labels_agree": all(expected[d]["label"] == found[d]["label"] for d in diseases),
+                "max_confidence_delta": max(abs(expected[d]["confidence"] - found[d]["confidence"]) for d in diseases),
+            }
+
+            entry = report[name]
+            print(f"{name:<20} {entry['file_mb']:6.1f} MB -> {native.size[0]}x{native.size[1]}  "
+                  f"convert-first {reference_stats['load_ms']:7.1f} ms {reference_stats['peak_mb']:6.1f} MB | "
+                  f"native {native_stats['load_ms']:6.1f} ms {native_stats['peak_mb']:5.1f} MB | "
+                  f"draft {draft_stats['load_ms']:6.1f} ms | upload {upload_stats['load_ms']:6.1f} ms | "
+                  f"input diff {entry['input_mean_abs_diff']:.4f}, labels agree {entry['labels_agree']}, "
+                  f"max conf delta {entry['max_confidence_delta']:.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
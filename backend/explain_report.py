@@ -0,0 +1,176 @@
+# Side-by-side and numeric comparison of CAM and Grad-CAM heatmaps
+#
+#   python explain_report.py --model models/final_lung_disease_model.pth \
+#       --data path/to/xrays --output-dir cam_vs_gradcam --json report.json
+#
+# Per disease: Pearson correlation of the 224x224 maps, IoU of their top-20% regions and the
+# distance between their peaks (pixels). Each image gets a PNG with rows per disease and
+# columns input | Grad-CAM | CAM. The batched Grad-CAM is also checked against the textbook one
+# (a backward hook and one backward pass per disease): the largest absolute difference of the maps.
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from utils.model_utils import (analyze_image, class_activation_maps, diseases, fast_preprocess, forward_features,
+                               get_gradcam, gradcam_target_layer, list_images, load_image, load_model,
+                               normalize_cams, overlay_base, render_overlay, to_model_input)
+
+
+def gradcam_maps(model, input_tensor):
+    gradcam = get_gradcam(model)
+    try:
+        outputs = model(input_tensor)
+        return gradcam.generate_multi(outputs, [output.argmax(dim=1).item() for output in outputs]).numpy()
+    finally:
+        gradcam.clear()
+
+
+# Reference Grad-CAM: hooks capture the target layer's output and its gradient, and each disease
+# gets its own backward pass from a one-hot of its predicted class
+def reference_gradcam_maps(model, input_tensor):
+    captured = {}
+    layer = gradcam_target_layer(model)
+    handles = [
+        layer.register_forward_hook(lambda module, input, output: captured.update(activations=output)),
+        layer.register_full_backward_hook(lambda module, grad_input, grad_output:
+                                          captured.update(gradients=grad_output[0])),
+    ]
+    try:
+        outputs = model(input_tensor)
+        cams = []
+        for output in outputs:
+            model.zero_grad()
+            one_hot = torch.zeros_like(output)
+            one_hot[0][output.argmax(dim=1).item()] = 1
+            output.backward(gradient=one_hot, retain_graph=True)
+            weights = captured["gradients"].detach().mean(dim=(2, 3))
+            cams.append(torch.einsum('kc,chw->khw', weights, captured["activations"].detach()[0]))
+        return normalize_cams(torch.cat(cams)).numpy()
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.zero_grad(set_to_none=True)
+
+
+def cam_maps(model, input_tensor):
+    with torch.inference_mode():
+        features, outputs = forward_features(model, input_tensor)
+        return class_activation_maps(model, features, [output.argmax(dim=1).item() for output in outputs]).numpy()
+
+
+def top_region_iou(a, b, fraction=0.2):
+    top_a = a >= np.quantile(a, 1 - fraction)
+    top_b = b >= np.quantile(b, 1 - fraction)
+    return (top_a & top_b).sum() / max(1, (top_a | top_b).sum())
+
+
+def peak_distance(a, b):
+    peak_a = np.unravel_index(a.argmax(), a.shape)
+    peak_b = np.unravel_index(b.argmax(), b.shape)
+    return float(np.hypot(peak_a[0] - peak_b[0], peak_a[1] - peak_b[1]))
+
+
+def correlation(a, b):
+    if a.std() == 0 or b.std() == 0:  # empty map, e.g. no positive evidence
+        return float(a.std() == b.std())
+    return float(np.corrcoef(a.ravel(), b.ravel())[0, 1])
+
+
+def compare_maps(reference, candidate):
+    return {
+        "correlation": correlation(reference, candidate),
+        "top20_iou": float(top_region_iou(reference, candidate)),
+        "peak_distance_px": peak_distance(reference, candidate),
+    }
+
+
+def side_by_side(image, gradcams, cams):
+    base = overlay_base(image)
+    sheet = Image.new('RGB', (3 * 224, len(diseases) * 224))
+    for row, (gradcam, cam) in enumerate(zip(gradcams, cams)):
+        sheet.paste(Image.fromarray(base), (0, row * 224))
+        sheet.paste(render_overlay(base, (255 * gradcam).astype(np.uint8)), (224, row * 224))
+        sheet.paste(render_overlay(base, (255 * cam).astype(np.uint8)), (448, row * 224))
+    return sheet
+
+
+def median_ms(fn, repeats):
+    fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return 1000 * statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CAM against Grad-CAM heatmaps")
+    parser.add_argument("--model", required=True, help="Checkpoint (.pth)")
+    parser.add_argument("--data", required=True, help="Image folder")
+    parser.add_argument("--output-dir", help="Write side-by-side PNGs here")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    paths = list_images(args.data)
+    if not paths:
+        parser.error(f"No images found in {args.data}")
+    model = load_model(args.model)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    scores = {disease: [] for disease in diseases}
+    reference_diffs = {disease: [] for disease in diseases}
+    for path in paths:
+        image = load_image(path)
+        input_tensor = to_model_input(fast_preprocess(image).unsqueeze(0), model)
+        gradcams, cams = gradcam_maps(model, input_tensor), cam_maps(model, input_tensor)
+        references = reference_gradcam_maps(model, input_tensor)
+
+        for disease, gradcam, cam, reference in zip(diseases, gradcams, cams, references):
+            scores[disease].append(compare_maps(gradcam, cam))
+            reference_diffs[disease].append(float(np.abs(gradcam - reference).max()))
+        if args.output_dir:
+            name = os.path.splitext(os.path.basename(path))[0]
+            side_by_side(image, gradcams, cams).save(os.path.join(args.output_dir, f"{name}.png"))
+
+    image = load_image(paths[0])
+    report = {
+        "images": len(paths),
+        "latency_ms": {
+            "predict": median_ms(lambda: analyze_image(image, model, explain=False), args.repeats),
+            "gradcam": median_ms(lambda: analyze_image(image, model, explain_mode="gradcam"), args.repeats),
+            "cam": median_ms(lambda: analyze_image(image, model, explain_mode="cam"), args.repeats),
+        },
+        "agreement": {
+            disease: {metric: statistics.fmean(score[metric] for score in values) for metric in values[0]}
+            for disease, values in scores.items()
+        },
+        "gradcam_vs_reference_max_abs_diff": {disease: max(diffs) for disease, diffs in reference_diffs.items()},
+    }
+
+    print(f"{len(paths)} images")
+    latency = report["latency_ms"]
+    print(f"latency: predict {latency['predict']:.1f} ms, predict + Grad-CAM {latency['gradcam']:.1f} ms, "
+          f"predict + CAM {latency['cam']:.1f} ms")
+    for disease, stats in report["agreement"].items():
+        print(f"  {disease:<13} correlation {stats['correlation']:.3f}  top-20% IoU {stats['top20_iou']:.3f}  "
+              f"peak distance {stats['peak_distance_px']:.1f} px")
+    print("batched Grad-CAM vs reference, max abs diff: " +
+          ", ".join(f"{disease} {diff:.2e}" for disease, diff in report["gradcam_vs_reference_max_abs_diff"].items()))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+# Export the checkpoint to ONNX and check it against the torch model (needs onnx and onnxruntime)
+#
+#   python export_onnx.py --model models/final_lung_disease_model.pth --output models/final_lung_disease_model.onnx
+
+import argparse
+import sys
+
+from utils.model_utils import load_model
+from utils.onnx_utils import OnnxModel, export_onnx, max_output_difference
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export MultiTaskDenseNet to ONNX")
+    parser.add_argument("--model", required=True, help="Checkpoint (.pth)")
+    parser.add_argument("--output", required=True, help="Destination .onnx file")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--atol", type=float, default=1e-4, help="Allowed max logit difference")
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    export_onnx(model, args.output, opset=args.opset)
+
+    difference = max_output_difference(model, OnnxModel(args.output))
+    print(f"Exported {args.output}; max |torch - onnx| logit difference {difference:.2e}")
+    if difference > args.atol:
+        sys.exit(f"ONNX outputs differ from torch by more than {args.atol}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# gunicorn -c gunicorn.conf.py server:app
+import json
+import os
+
+# Tuned settings from autotune.py, if any; the environment overrides them
+profile = {}
+if os.environ.get("RESPIRASCAN_RUNTIME_PROFILE"):
+    with open(os.environ["RESPIRASCAN_RUNTIME_PROFILE"]) as f:
+        profile = json.load(f)["best"]
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", profile.get("workers", 2)))
+threads = int(os.environ.get("RESPIRASCAN_THREADS", 16))
+timeout = 120
+
+# Import server.py (and load the model) once in the master before forking, so workers start
+# instantly and share the weights' pages instead of each deserializing the checkpoint
+preload_app = os.environ.get("RESPIRASCAN_PRELOAD", "1") == "1"
+
+# Pin each worker to its own slice of the cores, so workers do not oversubscribe them
+pin_workers = os.environ.get("RESPIRASCAN_PIN_WORKERS", "1" if profile.get("pin") else "0") == "1"
+
+# Core slice of each live worker, kept in the master. A worker takes the lowest free slice, so
+# one replacing a crashed or recycled worker gets the slice it left rather than sharing another's.
+cpu_slots = {}
+
+
+def pre_fork(server, worker):
+    taken = set(cpu_slots.values())
+    worker.cpu_slot = next(slot for slot in range(len(taken) + 1) if slot not in taken)
+    cpu_slots[worker] = worker.cpu_slot
+
+
+def child_exit(server, worker):
+    cpu_slots.pop(worker, None)
+
+
+# Warm up in each worker rather than in the master: running torch kernels before fork
+# can leave the children's OpenMP thread pool unusable
+def post_fork(server, worker):
+    import importlib
+
+    from utils.model_utils import warmup_model
+    from utils.runtime_utils import configure_runtime, runtime_config, worker_cpus
+
+    # Unset intra-op threads default to this worker's share of the cores
+    config = runtime_config(workers=server.cfg.workers)
+    if pin_workers:
+        config["cpu_affinity"] = worker_cpus(worker.cpu_slot, server.cfg.workers, config.get("cpu_affinity"))
+        server.log.info("worker %s pinned to core slice %d: %s", worker.pid, worker.cpu_slot, config["cpu_affinity"])
+    configure_runtime(**config)
+
+    registry = importlib.import_module("server").registry
+    warmup_model(registry.current().resources["model"], int(os.environ.get("RESPIRASCAN_WARMUP", 1)))
+    # Starts this worker's watcher for new checkpoints
+    registry.refresh()
@@ -0,0 +1,57 @@
+# Concurrent load generator for server.py
+#
+#   python loadgen.py path/to/xray.png --url http://localhost:8000/predict --concurrency 16 --requests 256
+
+import argparse
+import statistics
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+def build_multipart(image_bytes, filename):
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode() + image_bytes + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+def send(url, body, content_type):
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": content_type})
+    start = time.perf_counter()
+    with urllib.request.urlopen(req) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send concurrent requests to the RespiraScan server")
+    parser.add_argument("image", help="Image file to upload")
+    parser.add_argument("--url", default="http://localhost:8000/predict")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=256)
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as f:
+        body, content_type = build_multipart(f.read(), args.image)
+
+    # One warm-up request so model initialisation is not counted
+    send(args.url, body, content_type)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        latencies = sorted(pool.map(lambda _: send(args.url, body, content_type), range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.requests} requests, concurrency {args.concurrency}")
+    print(f"throughput: {args.requests / elapsed:.1f} req/s")
+    print(f"latency p50: {statistics.median(latencies) * 1000:.1f} ms")
+    print(f"latency p95: {latencies[int(0.95 * (len(latencies) - 1))] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Manage a model registry directory served by server.py / streamlit_app.py
+# (RESPIRASCAN_MODEL_PATH=models/)
+#
+#   python models.py add retrained.pth --name v2 --activate
+#   python models.py activate v1
+#   python models.py list
+#
+# add copies the checkpoint in under a temporary name and renames it into place, after checking
+# that it loads, so serving processes never see a partial file. Running servers load the newly
+# active checkpoint in the background and switch to it without a restart.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from utils.registry_utils import (active_checkpoint, active_filename, checkpoint_extension, list_checkpoints, set_active,
+                                  version_id)
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+
+def add(registry, source, name):
+    from utils.model_utils import load_model
+
+    # Refuse checkpoints that would only fail once a server tries to load them
+    load_model(source, mmap=True)
+    os.makedirs(registry, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=registry, suffix=".tmp", delete=False) as f:
+        with open(source, "rb") as src:
+            shutil.copyfileobj(src, f)
+    os.replace(f.name, os.path.join(registry, name + checkpoint_extension))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List, add and activate served checkpoints")
+    parser.add_argument("--registry", default=os.environ.get("RESPIRASCAN_MODEL_PATH", os.path.join(BASE_DIR, 'models')),
+                        help="Registry directory (default: RESPIRASCAN_MODEL_PATH, else models/)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="Checkpoints and which one is active")
+    add_parser = commands.add_parser("add", help="Copy a checkpoint into the registry")
+    add_parser.add_argument("checkpoint")
+    add_parser.add_argument("--name", help="Name to serve it under (default: the file name)")
+    add_parser.add_argument("--activate", action="store_true", help="Also make it the active checkpoint")
+    activate_parser = commands.add_parser("activate", help="Serve another checkpoint of the registry")
+    activate_parser.add_argument("name")
+    args = parser.parse_args()
+
+    # add creates the directory; everything else needs it to exist
+    if not os.path.isdir(args.registry) and (args.command != "add" or os.path.exists(args.registry)):
+        parser.error(f"{args.registry} is not a registry directory")
+
+    if args.command == "add":
+        name = args.name or os.path.splitext(os.path.basename(args.checkpoint))[0]
+        if os.path.isdir(args.registry) and name in list_checkpoints(args.registry):
+            parser.error(f"{name} is already in {args.registry}; checkpoints are versioned by name")
+        # Without an ACTIVE file the newest checkpoint is served, so pin the current one first
+        if os.path.isdir(args.registry) and list_checkpoints(args.registry) and \
+                not os.path.exists(os.path.join(args.registry, active_filename)):
+            set_active(args.registry, active_checkpoint(args.registry)[0])
+        add(args.registry, args.checkpoint, name)
+        print(f"added {version_id(name, os.path.join(args.registry, name + checkpoint_extension))}", file=sys.stderr)
+        if args.activate:
+            set_active(args.registry, name)
+            print(f"activated {name}", file=sys.stderr)
+    elif args.command == "activate":
+        try:
+            set_active(args.registry, args.name)
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"activated {args.name}", file=sys.stderr)
+    else:
+        active = active_checkpoint(args.registry)[0] if list_checkpoints(args.registry) else None
+        for name, path in list_checkpoints(args.registry).items():
+            modified = time.strftime("%Y-%m-%d %H:%M", time.localtime(os.path.getmtime(path)))
+            print(f"{'*' if name == active else ' '} {version_id(name, path):<48} "
+                  f"{os.path.getsize(path) / 2 ** 20:7.1f} MB  {modified}")
+
+
+if __name__ == "__main__":
+    main()
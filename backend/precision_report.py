@@ -0,0 +1,96 @@
+# Accuracy-parity and latency report for reduced-precision models
+#
+#   python precision_report.py --model models/final_lung_disease_model.pth \
+#       --data path/to/held_out --calibration path/to/calibration --json report.json
+
+import argparse
+import io
+import json
+import statistics
+import time
+
+import torch
+
+from utils.model_utils import diseases, fast_preprocess, list_images, load_image, load_model, predict_batch
+
+
+def state_dict_bytes(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def single_image_latency(model, input_tensor, repeats):
+    predict_batch(input_tensor, model)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict_batch(input_tensor, model)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def compare(reference, candidate):
+    report = {}
+    for disease in diseases:
+        agree = [ref[disease]["label"] == cand[disease]["label"] for ref, cand in zip(reference, candidate)]
+        deltas = [abs(ref[disease]["confidence"] - cand[disease]["confidence"]) for ref, cand in zip(reference, candidate)]
+        report[disease] = {
+            "label_agreement": sum(agree) / len(agree),
+            "mean_confidence_delta": statistics.fmean(deltas),
+            "max_confidence_delta": max(deltas),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare bf16/int8 models against fp32 on a held-out folder")
+    parser.add_argument("--model", required=True, help="Checkpoint (.pth)")
+    parser.add_argument("--data", required=True, help="Held-out image folder")
+    parser.add_argument("--calibration", help="Calibration image folder for int8 (must not overlap --data)")
+    parser.add_argument("--precisions", nargs="+", default=["bf16", "int8"])
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    paths = list_images(args.data)
+    if not paths:
+        parser.error(f"No images found in {args.data}")
+    inputs = torch.stack([fast_preprocess(load_image(path)) for path in paths])
+
+    results = {}
+    for precision in ["fp32"] + [p for p in args.precisions if p != "fp32"]:
+        model = load_model(args.model, precision=precision, calibration_images=args.calibration)
+        predictions = predict_batch(inputs, model, batch_size=args.batch_size)
+
+        results[precision] = {
+            "predictions": predictions,
+            "latency_ms": 1000 * single_image_latency(model, inputs[:1], args.repeats),
+            "weights_mb": state_dict_bytes(model) / 2 ** 20,
+        }
+
+    report = {"images": len(paths)}
+    for precision, result in results.items():
+        report[precision] = {
+            "latency_ms": round(result["latency_ms"], 2),
+            "weights_mb": round(result["weights_mb"], 2),
+        }
+        if precision != "fp32":
+            report[precision]["parity"] = compare(results["fp32"]["predictions"], result["predictions"])
+
+    print(f"{len(paths)} held-out images")
+    for precision in results:
+        entry = report[precision]
+        print(f"\n{precision}: {entry['latency_ms']:.1f} ms/image, {entry['weights_mb']:.1f} MB weights")
+        for disease, stats in entry.get("parity", {}).items():
+            print(f"  {disease:<13} agreement {stats['label_agreement'] * 100:6.2f}%  "
+                  f"mean |dconf| {stats['mean_confidence_delta']:.4f}  max |dconf| {stats['max_confidence_delta']:.4f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Re-score an embedding store written by scan.py --embeddings with new heads or thresholds,
+# without running the backbone again
+#
+#   python scan.py data/xrays --output results.csv --embeddings embeddings/
+#   python rescore.py --embeddings embeddings/ --heads retrained.pth --output rescored.csv
+#   python rescore.py --embeddings embeddings/ --threshold Tuberculosis=0.3 --output rescored.jsonl
+#
+# The heads checkpoint must share the store's backbone: a full checkpoint whose backbone weights
+# differ is refused unless --force is given.
+#
+# The heads version and thresholds behind an output are kept in <output>.rescore.json. Rerunning
+# with the same ones resumes an interrupted run; other heads or thresholds are refused for an
+# existing output unless --overwrite starts it afresh.
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from utils.embedding_utils import EmbeddingStore, check_backbone, heads_version, load_heads, rescore
+from utils.model_utils import diseases
+from utils.scan_utils import ResultWriter, result_row
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+
+# "Tuberculosis=0.3" -> ("Tuberculosis", 0.3)
+def parse_threshold(value):
+    name, _, cutoff = value.partition("=")
+    if name not in diseases or not cutoff:
+        raise argparse.ArgumentTypeError(f"expected Disease=probability with Disease one of {', '.join(diseases)}")
+    return name, float(cutoff)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score stored backbone embeddings")
+    parser.add_argument("--embeddings", required=True, help="Directory written by scan.py --embeddings")
+    parser.add_argument("--heads", default=os.path.join(BASE_DIR, 'models', 'final_lung_disease_model.pth'),
+                        help="Checkpoint holding the disease heads (full model or heads only)")
+    parser.add_argument("--threshold", action="append", type=parse_threshold, default=[],
+                        help="Disease=probability cutoff for the positive label (repeatable)")
+    parser.add_argument("--output", required=True, help="Results file (.csv or .jsonl)")
+    parser.add_argument("--chunk-size", type=int, default=65536, help="Embeddings scored per step")
+    parser.add_argument("--force", action="store_true", help="Use heads trained on a different backbone")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Replace an existing output instead of resuming it")
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.embeddings, "meta.json")):
+        parser.error(f"{args.embeddings} is not an embedding store")
+    store = EmbeddingStore(args.embeddings)
+
+    # Heads-only checkpoints carry no backbone to compare
+    if not args.force:
+        try:
+            check_backbone(store, args.heads)
+        except ValueError as e:
+            sys.exit(f"{e}; pass --force to score anyway")
+
+    # Rows of an existing output only count as done if the same heads and thresholds scored them
+    scoring = {"heads_version": heads_version(args.heads), "thresholds": dict(sorted(args.threshold)),
+               "backbone_version": store.meta["backbone_version"]}
+    meta_path = args.output + ".rescore.json"
+    if args.overwrite:
+        for path in (args.output, meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+    elif os.path.exists(args.output) and os.path.getsize(args.output) > 0:
+        previous = None
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                previous = json.load(f)
+        if previous != scoring:
+            found = "no record of its heads" if previous is None else f"heads {previous['heads_version']}, " \
+                f"thresholds {previous['thresholds'] or 'default'}"
+            sys.exit(f"{args.output} was scored with {found}, not heads {scoring['heads_version']}, thresholds "
+                     f"{scoring['thresholds'] or 'default'}; pass --overwrite or choose another --output")
+    with open(meta_path, "w") as f:
+        json.dump(scoring, f, indent=2)
+
+    start = time.perf_counter()
+    writer = ResultWriter(args.output)
+    counts = {"scored": 0, "skipped": 0}
+    rows = []
+    try:
+        # Ids already in the output were written by an earlier, interrupted run
+        for item_id, prediction in rescore(store, load_heads(args.heads), dict(args.threshold) or None,
+                                           chunk_size=args.chunk_size):
+            if item_id in writer.finished:
+                counts["skipped"] += 1
+                continue
+            rows.append(result_row(item_id, prediction))
+            counts["scored"] += 1
+            if len(rows) == args.chunk_size:
+                writer.write(rows)
+                rows.clear()
+        writer.write(rows)
+    finally:
+        writer.close()
+
+    print(f"rescored {counts['scored']} embeddings in {time.perf_counter() - start:.1f} s, "
+          f"skipped {counts['skipped']} already in {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
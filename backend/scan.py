@@ -0,0 +1,77 @@
+# Bulk scan folders, glob patterns or ZIP archives of chest X-rays
+#
+#   python scan.py data/xrays "archive/*.png" exports.zip --output results.csv
+#
+# Results are appended as each batch finishes; rerunning the same command resumes an interrupted scan
+# and retries the images that failed.
+# --embeddings DIR also keeps every image's backbone features, so rescore.py can apply new heads or
+# thresholds later without running the backbone again, and updates the similar-case index the
+# server's /similar endpoint searches.
+
+import argparse
+import os
+import sys
+import time
+
+from utils.embedding_utils import EmbeddingStore, backbone_version
+from utils.model_utils import load_model
+from utils.runtime_utils import configure_runtime, runtime_config
+from utils.scan_utils import scan
+from utils.similarity_utils import SimilarityIndex
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch-score chest X-rays to CSV or JSONL")
+    parser.add_argument("sources", nargs="+", help="Directories, glob patterns or ZIP archives")
+    parser.add_argument("--output", required=True, help="Results file (.csv or .jsonl)")
+    parser.add_argument("--model", default=os.path.join(BASE_DIR, 'models', 'final_lung_disease_model.pth'))
+    parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16", "int8"])
+    parser.add_argument("--calibration", help="Calibration image folder for --precision int8")
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx"])
+    parser.add_argument("--optimize", choices=["torchscript", "compile"])
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=4, help="Decode/preprocess threads")
+    parser.add_argument("--prefetch", type=int, default=2, help="Batches decoded ahead of inference")
+    parser.add_argument("--draft", action="store_true", help="Reduced-size JPEG decode, strided DICOM sampling (faster, not bit-identical)")
+    parser.add_argument("--embeddings", help="Also store pooled backbone features in this directory (eager torch only)")
+    args = parser.parse_args()
+
+    # RESPIRASCAN_RUNTIME_PROFILE / RESPIRASCAN_*_THREADS, as for the server
+    configure_runtime(**runtime_config())
+    try:
+        model = load_model(args.model, precision=args.precision, calibration_images=args.calibration,
+                           backend=args.backend, optimize=args.optimize)
+    except ValueError as e:
+        parser.error(str(e))
+
+    embeddings = None
+    if args.embeddings:
+        embeddings = EmbeddingStore(args.embeddings, backbone_version(args.model, args.precision), writable=True)
+        stored_before = len(embeddings)
+
+    start = time.perf_counter()
+
+    def progress(counts):
+        rate = counts["scored"] / (time.perf_counter() - start)
+        print(f"\rscored {counts['scored']}  failed {counts['failed']}  ({rate:.1f} img/s)", end="", file=sys.stderr)
+
+    counts = scan(args.sources, model, args.output, batch_size=args.batch_size,
+                  workers=args.workers, prefetch=args.prefetch, draft=args.draft, progress=progress,
+                  embeddings=embeddings)
+
+    print(f"\nscored {counts['scored']}, failed {counts['failed']}, "
+          f"skipped {counts['skipped']} already in {args.output}", file=sys.stderr)
+
+    if embeddings is not None:
+        index = SimilarityIndex(embeddings)
+        index.sync()
+        index.save()
+        # The store also holds the superseded rows of re-scanned images; count each image once
+        print(f"indexed {len(embeddings) - stored_before} new embeddings "
+              f"({len(embeddings.index)} images in {args.embeddings})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+# HTTP inference service for RespiraScan
+#
+#   gunicorn -c gunicorn.conf.py server:app
+#
+# Concurrent /predict requests inside a worker are grouped by the micro-batcher,
+# so prefer more threads per worker over more workers. The checkpoint is memory-mapped
+# (RESPIRASCAN_MMAP=0 to disable), so workers share one copy of the weights.
+# CPU threads and affinity come from RESPIRASCAN_RUNTIME_PROFILE (see autotune.py) and the
+# RESPIRASCAN_{INTRA_OP,INTER_OP,CV2}_THREADS / RESPIRASCAN_CPU_AFFINITY overrides.
+#
+# RESPIRASCAN_METRICS=1 records per-stage timings, served at /metrics in Prometheus format
+# (and logged as JSON with RESPIRASCAN_LOG_LEVEL=INFO). With RESPIRASCAN_PROFILE_DIR set,
+# adding ?profile=1 to a request writes a Chrome trace of it to that directory (one trace at a time per
+# worker: 409 while another is being recorded).
+#
+# Heatmaps can be produced synchronously (POST /explain) or as background jobs: POST /jobs, or
+# POST /predict?explain=positive, returns a job id to poll with GET /jobs/<id> and cancel with
+# DELETE /jobs/<id>. At most RESPIRASCAN_EXPLAIN_MAX_PENDING jobs wait at once (429 beyond that),
+# so a burst of explanations never queues in front of /predict.
+#
+# Heatmaps are 224x224 overlays, sent as PNG unless ?format=jpeg or ?format=webp asks for a smaller
+# encoding (RESPIRASCAN_HEATMAP_FORMAT sets the default). ?cams=1 adds each raw map at the activation
+# grid size as base64 uint8 ("shape" [h, w]), and ?heatmaps=0 with ?cams=1 skips the overlays.
+#
+# With RESPIRASCAN_EMBEDDINGS_DIR pointing at a store written by scan.py --embeddings, POST /similar?k=
+# returns the predictions and the k most similar stored cases. Cases scanned into the store later are
+# indexed at the next query.
+#
+# RESPIRASCAN_MODEL_PATH is a checkpoint file or a registry directory of <name>.pth checkpoints (see
+# models.py). When the file is replaced, or the directory's ACTIVE file names another checkpoint, each
+# worker loads and warms up the new version in the background (noticed within
+# RESPIRASCAN_MODEL_POLL_SECONDS of a request) and swaps it in; requests and jobs already running finish
+# on the version they started with, and the old weights are freed after them. Responses name the version
+# that produced them in an X-Model-Version header, and in a "model_version" field of JSON objects that
+# wrap predictions. GET /models lists the checkpoints and what each worker is serving or loading.
+# Replace a checkpoint by renaming a complete file into place (as models.py add does), so a version is
+# never read half-written. Memory-mapped checkpoints (RESPIRASCAN_MMAP=1) are served from a copy under
+# .snapshots/ next to them, so copying over a checkpoint in place cannot change the live weights either.
+
+import base64
+import logging
+import os
+import time
+from contextlib import contextmanager, nullcontext
+
+from flask import Flask, Response, g, jsonify, request
+from flask_cors import CORS
+
+from utils.cache_utils import encode_image, image_formats
+from utils.embedding_utils import EmbeddingStore, check_backbone
+from utils.job_utils import ExplanationQueue, QueueFull
+from utils.model_utils import (Explanation, diseases, explain_modes, fast_preprocess, load_image, load_model,
+                               predict_batch)
+from utils.metrics_utils import ProfilerBusy, metrics, profile_trace, timed
+from utils.registry_utils import ModelRegistry
+from utils.runtime_utils import configure_runtime, runtime_config, runtime_configured
+from utils.serving_utils import MicroBatcher
+from utils.similarity_utils import SimilarityIndex
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+MODEL_PATH = os.environ.get(
+    "RESPIRASCAN_MODEL_PATH",
+    os.path.join(BASE_DIR, 'models', 'final_lung_disease_model.pth')
+)
+MAX_BATCH_SIZE = int(os.environ.get("RESPIRASCAN_MAX_BATCH_SIZE", 16))
+MAX_WAIT_MS = float(os.environ.get("RESPIRASCAN_MAX_WAIT_MS", 10))
+# fp32, bf16 or int8 for /predict; int8 needs RESPIRASCAN_CALIBRATION_DIR for the backbone
+PRECISION = os.environ.get("RESPIRASCAN_PRECISION", "fp32")
+CALIBRATION_DIR = os.environ.get("RESPIRASCAN_CALIBRATION_DIR")
+PROFILE_DIR = os.environ.get("RESPIRASCAN_PROFILE_DIR")
+MMAP = os.environ.get("RESPIRASCAN_MMAP", "1") == "1"
+WARMUP = int(os.environ.get("RESPIRASCAN_WARMUP", 1))
+MODEL_POLL_SECONDS = float(os.environ.get("RESPIRASCAN_MODEL_POLL_SECONDS", 5))
+# Default /explain heatmaps: "gradcam", or "cam" for forward-only cost; ?mode= overrides per request
+EXPLAIN_MODE = os.environ.get("RESPIRASCAN_EXPLAIN_MODE", "gradcam")
+EXPLAIN_WORKERS = int(os.environ.get("RESPIRASCAN_EXPLAIN_WORKERS", 1))
+EXPLAIN_MAX_PENDING = int(os.environ.get("RESPIRASCAN_EXPLAIN_MAX_PENDING", 32))
+HEATMAP_FORMAT = os.environ.get("RESPIRASCAN_HEATMAP_FORMAT", "png")
+EMBEDDINGS_DIR = os.environ.get("RESPIRASCAN_EMBEDDINGS_DIR")
+MAX_SIMILAR = 100
+
+logging.basicConfig(level=os.environ.get("RESPIRASCAN_LOG_LEVEL", "WARNING"))
+
+app = Flask(__name__)
+CORS(app)
+
+# A gunicorn worker importing this module after fork (RESPIRASCAN_PRELOAD=0) has already been given
+# its share of the cores by post_fork
+if not runtime_configured():
+    configure_runtime(**runtime_config())
+
+# Loaded before workers fork, so they share the index pages
+embeddings = similar_index = None
+if EMBEDDINGS_DIR:
+    embeddings = EmbeddingStore(EMBEDDINGS_DIR)
+    similar_index = SimilarityIndex(embeddings)
+    similar_index.sync()
+
+
+# Everything served from one checkpoint: the /predict model behind its micro-batcher and the eager
+# model heatmaps and embeddings need (a separate fp32 copy under int8, which lacks the eager structure).
+# "similar_error" says why /similar cannot use this checkpoint's embeddings, if it cannot.
+def load_served(path, warmup=WARMUP):
+    model = load_model(path, precision=PRECISION, calibration_images=CALIBRATION_DIR, mmap=MMAP, warmup=warmup)
+    explain_model = model if PRECISION != "int8" else load_model(path, mmap=MMAP)
+    similar_error = None
+    if embeddings is not None:
+        try:
+            check_backbone(embeddings, path)
+        except ValueError as e:
+            similar_error = str(e)
+    return {"model": model, "explain_model": explain_model, "similar_error": similar_error,
+            "batcher": MicroBatcher(model, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS)}
+
+
+def close_served(served):
+    served["batcher"].close()
+
+
+registry = ModelRegistry(MODEL_PATH, load_served, close_served, poll_interval=MODEL_POLL_SECONDS, snapshot=MMAP)
+# Warmed up in each worker after the fork (see gunicorn.conf.py); later versions warm up as they load
+registry.load_now(lambda path: load_served(path, warmup=0))
+jobs = ExplanationQueue(workers=EXPLAIN_WORKERS, max_pending=EXPLAIN_MAX_PENDING,
+                        explain_mode=EXPLAIN_MODE, heatmap_format=HEATMAP_FORMAT)
+
+
+# Lease the serving version for the rest of the request, after checking for a new one
+@contextmanager
+def served_model():
+    registry.refresh()
+    with registry.lease() as served:
+        g.model_version = served.version
+        yield served
+
+
+@app.after_request
+def add_model_version(response):
+    if "model_version" in g:
+        response.headers["X-Model-Version"] = g.model_version
+    return response
+
+
+def read_image():
+    uploaded_file = request.files.get('image')
+    if uploaded_file is None:
+        return None
+    return load_image(uploaded_file.stream)
+
+
+def b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def encode_cams(cams):
+    return {disease: {"shape": list(cam.shape), "data": b64(cam.tobytes())} for disease, cam in cams.items()}
+
+
+# ?format= value: one of image_formats
+def requested_format():
+    heatmap_format = request.args.get('format', HEATMAP_FORMAT)
+    if heatmap_format not in image_formats:
+        raise ValueError(f"format must be one of {', '.join(image_formats)}")
+    return heatmap_format
+
+
+# ?diseases= / ?explain= values: "all", "positive" (heads predicting Disease) or a comma-separated list
+def requested_diseases(value, predictions=None):
+    if value in (None, "all"):
+        return list(diseases)
+    if value == "positive":
+        if predictions is None:
+            return None
+        return [name for name in diseases if predictions[name]["label"] == "Disease"]
+    names = value.split(',')
+    unknown = set(names) - set(diseases)
+    if unknown:
+        raise ValueError(f"Unknown diseases: {', '.join(sorted(unknown))}")
+    return names
+
+
+def maybe_profile():
+    if not PROFILE_DIR or request.args.get('profile') != '1':
+        return nullcontext()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return profile_trace(os.path.join(PROFILE_DIR, f"{request.endpoint}-{time.time_ns()}.json"))
+
+
+# One ?profile=1 request at a time per worker
+@app.errorhandler(ProfilerBusy)
+def profiler_busy(e):
+    return jsonify({"error": str(e)}), 409, {"Retry-After": "1"}
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({"status": "ok", "model": registry.status(), "jobs": jobs.stats(),
+                    "similar": similar_index.stats() if similar_index is not None else None})
+
+
+@app.route('/models', methods=['GET'])
+def models():
+    registry.refresh()
+    return jsonify(dict(registry.status(), checkpoints=registry.versions()))
+
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    with maybe_profile():
+        try:
+            image = read_image()
+        except Exception as e:
+            return jsonify({"error": f"Could not read image: {e}"}), 400
+        if image is None:
+            return jsonify({"error": "Missing 'image' file field"}), 400
+
+        with served_model() as served:
+            predictions = served.resources["batcher"].predict(image)
+            if 'explain' not in request.args:
+                return jsonify(predictions)
+
+            # Predictions return now; heatmaps follow as a background job on the same version
+            try:
+                names = requested_diseases(request.args['explain'], predictions)
+                job = jobs.submit(image, names, request.args.get('mode'), heatmap_format=requested_format(),
+                                  model=served.resources["explain_model"], model_version=served.version) \
+                    if names else None
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            except QueueFull as e:
+                return jsonify({"predictions": predictions, "model_version": served.version, "job": None,
+                                "job_error": str(e)})
+            return jsonify({"predictions": predictions, "model_version": served.version,
+                            "job": job.info() if job else None})
+
+
+@app.route('/explain', methods=['POST'])
+def explain():
+    with maybe_profile():
+        try:
+            image = read_image()
+        except Exception as e:
+            return jsonify({"error": f"Could not read image: {e}"}), 400
+        if image is None:
+            return jsonify({"error": "Missing 'image' file field"}), 400
+
+        mode = request.args.get('mode', EXPLAIN_MODE)
+        if mode not in explain_modes:
+            return jsonify({"error": f"mode must be one of {', '.join(explain_modes)}"}), 400
+
+        try:
+            names = requested_diseases(request.args.get('diseases'))
+            heatmap_format = requested_format()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        with_cams = request.args.get('cams') == '1'
+        with_heatmaps = request.args.get('heatmaps') != '0' or not with_cams
+
+        with served_model() as served, Explanation(image, served.resources["explain_model"], mode) as explanation:
+            predictions = explanation.predictions
+            if names is None:
+                names = requested_diseases("positive", predictions)
+            cams = explanation.cams(names) if with_cams else None
+            heatmaps = explanation.heatmaps(names) if with_heatmaps else {}
+
+        with timed("encode"):
+            image_format, quality = image_formats[heatmap_format]
+            encoded = {disease: b64(encode_image(heatmap, image_format, quality)) for disease, heatmap in heatmaps.items()}
+
+        response = {"predictions": predictions, "model_version": served.version, "heatmaps": encoded,
+                    "heatmap_format": heatmap_format}
+        if with_cams:
+            response["cams"] = encode_cams(cams)
+        return jsonify(response)
+
+
+@app.route('/similar', methods=['POST'])
+def similar():
+    if similar_index is None:
+        return jsonify({"error": "Similar-case search is not enabled (set RESPIRASCAN_EMBEDDINGS_DIR)"}), 404
+
+    with maybe_profile():
+        try:
+            image = read_image()
+        except Exception as e:
+            return jsonify({"error": f"Could not read image: {e}"}), 400
+        if image is None:
+            return jsonify({"error": "Missing 'image' file field"}), 400
+
+        try:
+            k = int(request.args.get('k', 10))
+        except ValueError:
+            return jsonify({"error": "k must be an integer"}), 400
+        if not 1 <= k <= MAX_SIMILAR:
+            return jsonify({"error": f"k must be between 1 and {MAX_SIMILAR}"}), 400
+
+        with served_model() as served:
+            if served.resources["similar_error"]:
+                return jsonify({"error": served.resources["similar_error"]}), 409
+            # Embeddings need the eager model (fp32 under int8 deployments), as for scan.py --embeddings
+            predictions, features = predict_batch([fast_preprocess(image)], served.resources["explain_model"],
+                                                  batch_size=1, return_features=True)
+        with timed("similar"):
+            # A retrain the new rows call for runs in the background; this query uses the current index
+            similar_index.sync(background=True)
+            matches = similar_index.search(features[0], k)
+
+        return jsonify({"predictions": predictions[0], "model_version": served.version,
+                        "similar": [{"id": item_id, "similarity": score} for item_id, score in matches]})
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    try:
+        image = read_image()
+    except Exception as e:
+        return jsonify({"error": f"Could not read image: {e}"}), 400
+    if image is None:
+        return jsonify({"error": "Missing 'image' file field"}), 400
+
+    try:
+        names = requested_diseases(request.args.get('diseases', "all"))
+        with served_model() as served:
+            job = jobs.submit(image, names, request.args.get('mode'), heatmap_format=requested_format(),
+                              model=served.resources["explain_model"], model_version=served.version)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": "1"}
+    return jsonify(job.info()), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+
+    # Heatmaps finished so far, also while the job is still running
+    with timed("encode"):
+        encoded = {disease: b64(data) for disease, data in list(job.heatmaps.items())}
+    response = dict(job.info(), predictions=job.predictions, heatmaps=encoded)
+    if request.args.get('cams') == '1':
+        response["cams"] = encode_cams(dict(job.cams))
+    return jsonify(response)
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    if jobs.get(job_id) is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    return jsonify({"cancelled": jobs.cancel(job_id)})
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 8000)), threaded=True)
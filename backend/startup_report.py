@@ -0,0 +1,95 @@
+# Cold-start report for the Streamlit app: each page is rendered once in a fresh process
+#
+#   python startup_report.py                         # random-weight checkpoint, this app
+#   python startup_report.py --app old_app.py --model models/final_lung_disease_model.pth
+#
+# first_render_ms is the time for the page's script run to finish, import_ms the part of it spent
+# importing modules, and ready_ms the time until the model is loaded (and warmed up) for analysis.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+HEAVY_MODULES = ("torch", "torchvision", "cv2", "numpy")
+
+PROBE = """
+import json, sys, threading, time
+from streamlit.testing.v1 import AppTest
+app, page = sys.argv[1], sys.argv[2]
+at = AppTest.from_file(app, default_timeout=600)
+at.session_state["page"] = page
+print("startup-probe-begin", file=sys.stderr, flush=True)
+start = time.perf_counter()
+at.run()
+rendered = time.perf_counter()
+print("startup-probe-end", file=sys.stderr, flush=True)
+heavy = [name for name in sys.argv[3:] if name in sys.modules]
+for thread in threading.enumerate():
+    if thread.name.startswith("model-load"):
+        thread.join()
+ready = time.perf_counter()
+print(json.dumps({"first_render_ms": 1000 * (rendered - start), "ready_ms": 1000 * (ready - start),
+                  "heavy_modules_at_render": heavy, "errors": [e.value for e in at.exception]}))
+"""
+
+
+# Sum of top-level cumulative import times (-X importtime) between the probe markers
+def import_ms(stderr):
+    total, inside = 0, False
+    for line in stderr.splitlines():
+        if line.startswith("startup-probe-"):
+            inside = line.endswith("begin")
+        elif inside and line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit() and not name.startswith("  "):
+                total += int(cumulative)
+    return total / 1000
+
+
+def measure(app, page, env):
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE, app, page, *HEAVY_MODULES],
+                             cwd=os.path.dirname(app), env=env, capture_output=True, text=True, check=True)
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result["import_ms"] = import_ms(process.stderr)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to first render of the RespiraScan Streamlit app")
+    parser.add_argument("--app", default=os.path.join(BASE_DIR, "streamlit_app.py"))
+    parser.add_argument("--model", help="Checkpoint (.pth); a random-weight one is written if omitted")
+    parser.add_argument("--pages", nargs="+", default=["Home", "About"])
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = args.model
+        if model_path is None:
+            import torch
+
+            from utils.model_utils import MultiTaskDenseNet
+
+            model_path = os.path.join(tmp, "model.pth")
+            torch.save(MultiTaskDenseNet().state_dict(), model_path)
+
+        env = dict(os.environ, RESPIRASCAN_MODEL_PATH=os.path.abspath(model_path))
+        report = {page: measure(os.path.abspath(args.app), page, env) for page in args.pages}
+
+    for page, result in report.items():
+        print(f"{page:<6} first render {result['first_render_ms']:8.0f} ms  "
+              f"(imports {result['import_ms']:6.0f} ms)  model ready {result['ready_ms']:8.0f} ms  "
+              f"heavy modules at render: {', '.join(result['heavy_modules_at_render']) or 'none'}")
+        for error in result["errors"]:
+            print(f"  error: {error}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
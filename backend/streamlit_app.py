@@ -1,14 +1,13 @@
 
 import streamlit as st
-from PIL import Image
-import torch
-from utils.model_utils import load_model, predict_image, apply_gradcam
+from utils.cache_utils import ResultCache, encode_image, image_formats, image_key, preview_image
+from utils.metrics_utils import metrics, profile_trace, timed
+from contextlib import nullcontext
+import importlib.util
+import logging
 import os
 import sys
-import base64
-
-# Skip torch internal C++ classes during hot-reloading
-sys.modules["torch.classes"] = None
+import time
 
 
 image_url = "https://ik.imagekit.io/ag1qvulim/lungs.png?updatedAt=1748351829845"
@@ -156,6 +155,7 @@ st.sidebar.markdown(
 page = st.sidebar.selectbox(
     "",
     ["Home", "About"],
+    key="page",
     label_visibility="collapsed"
 )
 
@@ -181,16 +181,100 @@ st.sidebar.markdown(
 )
 
 # === LOAD MODEL WITH CACHING ===
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+# A checkpoint file, or a registry directory of checkpoints managed with models.py
+MODEL_PATH = os.environ.get("RESPIRASCAN_MODEL_PATH",
+                            os.path.join(BASE_DIR, 'models', 'final_lung_disease_model.pth'))
+MODEL_POLL_SECONDS = float(os.environ.get("RESPIRASCAN_MODEL_POLL_SECONDS", 5))
+# Longest a run waits for the first checkpoint to load before reporting an error
+MODEL_LOAD_TIMEOUT = float(os.environ.get("RESPIRASCAN_MODEL_LOAD_TIMEOUT", 300))
+
+# "torchscript" or "compile" serves predictions from an optimized copy of the model;
+# heatmaps still come from the eager model
+MODEL_OPTIMIZE = os.environ.get("RESPIRASCAN_OPTIMIZE") or None
+MODEL_WARMUP = int(os.environ.get("RESPIRASCAN_WARMUP", 1))
+# "gradcam", or "cam" for heatmaps at forward-only cost
+EXPLAIN_MODE = os.environ.get("RESPIRASCAN_EXPLAIN_MODE", "gradcam")
+# Heatmaps generated without asking: "disease" (heads predicting Disease), "all" or "none";
+# the others are behind a button
+AUTO_HEATMAPS = os.environ.get("RESPIRASCAN_AUTO_HEATMAPS", "disease")
+EXPLAIN_WORKERS = int(os.environ.get("RESPIRASCAN_EXPLAIN_WORKERS", 1))
+EXPLAIN_MAX_PENDING = int(os.environ.get("RESPIRASCAN_EXPLAIN_MAX_PENDING", 32))
+# The upload is shown as a JPEG preview of at most this many pixels a side, and heatmaps are encoded
+# once by the explanation workers. st.image passes JPEG bytes within its width limit straight to the
+# browser; PIL images are encoded on every rerun (full-size uploads at JPEG quality 100) and other
+# formats re-encoded.
+PREVIEW_SIZE = int(os.environ.get("RESPIRASCAN_PREVIEW_SIZE", 1024))
+HEATMAP_FORMAT = os.environ.get("RESPIRASCAN_HEATMAP_FORMAT", "jpeg")
+
+# RESPIRASCAN_METRICS=1 records per-stage timings, as in server.py. The app serves no /metrics, so
+# they are logged as JSON with RESPIRASCAN_LOG_LEVEL=INFO and, with RESPIRASCAN_METRICS_FILE set,
+# written there in Prometheus format after every analysis (name it *.prom for node_exporter).
+# With RESPIRASCAN_PROFILE_DIR set, opening the app with ?profile=1 writes a Chrome trace of each
+# uncached analysis to that directory.
+METRICS_FILE = os.environ.get("RESPIRASCAN_METRICS_FILE")
+PROFILE_DIR = os.environ.get("RESPIRASCAN_PROFILE_DIR")
+logging.basicConfig(level=os.environ.get("RESPIRASCAN_LOG_LEVEL", "WARNING"))
+
+
+# One trace at a time per process: a second session profiling waits for the first
+def maybe_profile():
+    if not PROFILE_DIR or st.query_params.get("profile") != "1":
+        return nullcontext()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return profile_trace(os.path.join(PROFILE_DIR, f"analysis-{time.time_ns()}.json"), blocking=True)
+
+
+# (model_utils, model, fast_model) for one checkpoint. Runs in the registry's background thread, so
+# torch, torchvision and cv2 are imported (via utils.model_utils) without holding up page renders;
+# the About page never starts it
+def load_checkpoint(path):
+    from utils import model_utils
+    from utils.runtime_utils import configure_runtime, runtime_config
+
+    # Skip torch internal C++ classes during hot-reloading
+    sys.modules["torch.classes"] = None
+
+    configure_runtime(**runtime_config())
+
+    model = model_utils.load_model(path, warmup=MODEL_WARMUP)
+    fast_model = model
+    if MODEL_OPTIMIZE:
+        fast_model = model_utils.load_model(path, optimize=MODEL_OPTIMIZE, warmup=MODEL_WARMUP)
+    return (model_utils, model, fast_model)
+
+# A replaced checkpoint (or a new active one in a registry directory) is loaded and warmed up in the
+# background while sessions keep using the current one, then swapped in for the next rerun
+@st.cache_resource(show_spinner=False)
+def model_registry():
+    from utils.registry_utils import ModelRegistry
+
+    return ModelRegistry(MODEL_PATH, load_checkpoint, poll_interval=MODEL_POLL_SECONDS)
+
+# Heatmaps come from explanation workers shared by every session, so a burst of uploads
+# never holds up the predictions; each job runs on the model version it was submitted with
 @st.cache_resource(show_spinner=False)
-def load_cached_model():
-    BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-    model_path = os.path.join(BASE_DIR, 'models', 'final_lung_disease_model.pth')
-    return load_model(model_path)
+def explanation_queue():
+    from utils.job_utils import ExplanationQueue
 
-model = load_cached_model()
+    return ExplanationQueue(workers=EXPLAIN_WORKERS, max_pending=EXPLAIN_MAX_PENDING,
+                            explain_mode=EXPLAIN_MODE, heatmap_format=HEATMAP_FORMAT)
+
+# Results of earlier scans, shared across sessions and reruns
+@st.cache_resource(show_spinner=False)
+def load_result_cache():
+    return ResultCache(
+        model_version=None,
+        max_entries=int(os.environ.get("RESPIRASCAN_CACHE_ENTRIES", 128)),
+        max_bytes=int(os.environ.get("RESPIRASCAN_CACHE_MB", 64)) << 20,
+        disk_dir=os.environ.get("RESPIRASCAN_CACHE_DIR"),
+    )
 
 # === HOME PAGE ===
 if page == "Home":
+    registry = model_registry()
+    registry.refresh()
+    result_cache = load_result_cache()
     
    # Display the header with embedded base64 image
     st.markdown(
@@ -218,7 +302,8 @@ if page == "Home":
 
     uploaded_file = st.file_uploader(
         "Upload a chest X-ray image:",
-        type=["jpg", "jpeg", "png"],
+        # DICOM exports need pydicom
+        type=["jpg", "jpeg", "png"] + (["dcm"] if importlib.util.find_spec("pydicom") else []),
         label_visibility="visible"
     )
     
@@ -227,54 +312,141 @@ if page == "Home":
     if uploaded_file is not None:
         
         try:
-            image = Image.open(uploaded_file).convert('RGB')
+            if not registry.ready():
+                with st.spinner("Loading model..."):
+                    registry.current(timeout=MODEL_LOAD_TIMEOUT)
+            # These references keep this version's models alive for the rest of the run, even if a
+            # newer one is swapped in meanwhile
+            with registry.lease(timeout=MODEL_LOAD_TIMEOUT) as served:
+                model_utils, model, fast_model = served.resources
+                model_version = served.version
+            result_cache.set_model_version(model_version)
+            image = model_utils.load_image(uploaded_file)
 
             # Use a more balanced layout: 1:1 or 4:3 for image vs results
             col1, col2 = st.columns([4, 5])
 
+            cache_key = image_key(image, f"{model_version}:{EXPLAIN_MODE}")
+            cached = result_cache.get(cache_key)
+            preview = cached.get("preview") if cached else None
+            if preview is None:
+                with timed("encode"):
+                    preview = encode_image(preview_image(image, PREVIEW_SIZE), *image_formats["jpeg"])
+
             with col1:
                 st.subheader("Input Image")
-                st.image(image, use_container_width=True, clamp=True)
+                st.image(preview, use_container_width=True)
             
             with st.spinner(""):
-                predictions = predict_image(image, model)
-                gradcam_maps = apply_gradcam(image.copy(), model)
-
-            with col2:
-                st.subheader("Diagnosis Results")
-                max_disease = max(
-                    ((disease, info) for disease, info in predictions.items()
-                     if info['label'] == 'Disease'),
-                    key=lambda x: x[1]['confidence'],
-                    default=(None, None)
-                )
-
-                if max_disease[0]:
-                    st.warning(
-                        f"🚨 Highest Confidence: {max_disease[0]} "
-                        f"({max_disease[1]['confidence']*100:.1f}%)"
+                if cached is None:
+                    # Heatmaps are generated below, once the predictions are on screen
+                    with maybe_profile():
+                        predictions = model_utils.predict_image(image, fast_model)
+                    cached = {"predictions": predictions, "heatmaps": {}, "preview": preview,
+                              "model_version": model_version}
+                    result_cache.put(cache_key, cached)
+                elif "preview" not in cached:
+                    cached = dict(cached, preview=preview)
+                    result_cache.put(cache_key, cached)
+
+                predictions = cached["predictions"]
+
+            with timed("render"):
+                with col2:
+                    st.subheader("Diagnosis Results")
+                    max_disease = max(
+                        ((disease, info) for disease, info in predictions.items()
+                         if info['label'] == 'Disease'),
+                        key=lambda x: x[1]['confidence'],
+                        default=(None, None)
                     )
-                else:
-                    st.success("✅ No abnormalities detected")
-
-                for disease, result in predictions.items():
-                    emoji = "⚠️" if result['label'] == 'Disease' else "✅"
-                    st.metric(
-                        label=f"{emoji} {disease}",
-                        value=f"{result['confidence']*100:.1f}%",
-                        help=f"Confidence: {result['confidence']*100:.1f}%"
-                    )
-
-            st.markdown("<hr class='custom-hr'>", unsafe_allow_html=True)
-
-            st.subheader("Heatmap Visualizations")
 
-            cols = st.columns(3)
-            heatmap_names = ["Pneumonia", "Tuberculosis", "Fibrosis"]
-            for col, name in zip(cols, heatmap_names):
-                with col:
-                    st.image(gradcam_maps[name], use_container_width=True)
-                    st.markdown(f"<p style='text-align: center; font-weight: 600;'>{name} Heatmap</p>", unsafe_allow_html=True)
+                    if max_disease[0]:
+                        st.warning(
+                            f"🚨 Highest Confidence: {max_disease[0]} "
+                            f"({max_disease[1]['confidence']*100:.1f}%)"
+                        )
+                    else:
+                        st.success("✅ No abnormalities detected")
+
+                    for disease, result in predictions.items():
+                        emoji = "⚠️" if result['label'] == 'Disease' else "✅"
+                        st.metric(
+                            label=f"{emoji} {disease}",
+                            value=f"{result['confidence']*100:.1f}%",
+                            help=f"Confidence: {result['confidence']*100:.1f}%"
+                        )
+                    st.caption(f"Model version: {cached.get('model_version', model_version)}")
+
+                st.markdown("<hr class='custom-hr'>", unsafe_allow_html=True)
+
+                st.subheader("Heatmap Visualizations")
+
+                cols = st.columns(3)
+                slots = {}
+                for col, name in zip(cols, predictions):
+                    with col:
+                        slots[name] = st.empty()
+                        st.markdown(f"<p style='text-align: center; font-weight: 600;'>{name} Heatmap</p>", unsafe_allow_html=True)
+
+            # Fill the slots: cached heatmaps straight away, the requested ones from explanation jobs
+            # as each heatmap finishes. Jobs outlive reruns and are cancelled when another image is uploaded.
+            from utils.job_utils import QueueFull
+
+            jobs = explanation_queue()
+            session_jobs = st.session_state.setdefault("heatmap_jobs", {})
+            if session_jobs.get("key") != cache_key:
+                for job_id in set(session_jobs.get("ids", {}).values()):
+                    jobs.cancel(job_id)
+                session_jobs.update(key=cache_key, ids={})
+
+            waiting, requested = {}, []
+            for name, slot in slots.items():
+                job = jobs.get(session_jobs["ids"].get(name))
+                if name in cached["heatmaps"]:
+                    slot.image(cached["heatmaps"][name], use_container_width=True)
+                    continue
+                if job is not None and job.status in ("queued", "running", "done"):
+                    waiting[name] = job
+                elif (AUTO_HEATMAPS == "all"
+                      or (AUTO_HEATMAPS == "disease" and predictions[name]['label'] == 'Disease')
+                      or slot.button(f"Show {name} heatmap", key=f"heatmap-{name}-{cache_key}")):
+                    requested.append(name)
+                else:
+                    continue
+                slot.info("⏳ Generating heatmap...")
+
+            def store_heatmaps(job, cache_key=cache_key, predictions=predictions):
+                entry = result_cache.get(cache_key) or {"predictions": predictions, "heatmaps": {},
+                                                        "model_version": job.model_version}
+                result_cache.put(cache_key, dict(entry, heatmaps=dict(entry["heatmaps"], **job.heatmaps)))
+
+            if requested:
+                try:
+                    job = jobs.submit(image, requested, callback=store_heatmaps, model=model,
+                                      model_version=model_version)
+                except QueueFull:
+                    for name in requested:
+                        slots[name].warning("⏳ Heatmaps are busy, please try again shortly.")
+                else:
+                    for name in requested:
+                        waiting[name] = job
+                        session_jobs["ids"][name] = job.id
+
+            while waiting:
+                for name, job in list(waiting.items()):
+                    if name in job.heatmaps:
+                        slots[name].image(job.heatmaps[name], use_container_width=True)
+                    elif job.done():
+                        slots[name].warning(f"Heatmap {job.status}: {job.error or 'no result'}")
+                    else:
+                        continue
+                    del waiting[name]
+                if waiting:
+                    time.sleep(0.1)
+
+            if METRICS_FILE:
+                metrics.write_prometheus(METRICS_FILE)
                     
         except Exception as e:
             st.error(f"❌ Error processing image: {str(e)}")
@@ -0,0 +1,232 @@
+import hashlib
+import io
+import os
+import pickle
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+_checkpoint_versions = {}
+
+
+# Content hash of a checkpoint, recomputed only when its size or mtime changes
+def checkpoint_version(path):
+    stat = os.stat(path)
+    stamp = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    if stamp not in _checkpoint_versions:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        _checkpoint_versions[stamp] = digest.hexdigest()[:16]
+
+    return _checkpoint_versions[stamp]
+
+
+# Cache key from the decoded pixels, so re-encoded or renamed uploads still hit
+def image_key(image, model_version):
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:{model_version}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+# Transfer formats for heatmaps and previews: PIL format name and default quality
+image_formats = {"png": ("PNG", None), "jpeg": ("JPEG", 85), "webp": ("WEBP", 80)}
+
+
+def encode_image(image, format='PNG', quality=None):
+    buffer = io.BytesIO()
+    if quality is None:
+        image.save(buffer, format=format)
+    else:
+        image.save(buffer, format=format, quality=quality)
+    return buffer.getvalue()
+
+
+# Downscaled copy for display, with the longest side at most max_size pixels
+def preview_image(image, max_size=1024):
+    if max(image.size) <= max_size:
+        return image
+    preview = image.copy()
+    preview.thumbnail((max_size, max_size), Image.BILINEAR, reducing_gap=2.0)
+    return preview
+
+
+def entry_size(entry):
+    return 1024 + len(entry.get("preview") or b"") + sum(len(data) for data in entry.get("heatmaps", {}).values())
+
+
+# The disk tier's own subdirectory of disk_dir, and the version directories it may delete there:
+# <checkpoint name>-<content hash>, as registry version ids are
+disk_subdir = "respirascan-results"
+disk_version_pattern = re.compile(r".+-[0-9a-f]{16}")
+
+
+# Bounded LRU of {"predictions": ..., "heatmaps": {disease: encoded bytes}, "preview": encoded bytes} entries,
+# with an optional on-disk tier under disk_dir/respirascan-results/<model_version>/. The disk budget
+# spans every version, least recently used files first, so results of a version that is swapped
+# out and back in survive; version directories unused for max_disk_age seconds are removed.
+class ResultCache:
+    def __init__(self, model_version, max_entries=128, max_bytes=64 << 20,
+                 disk_dir=None, max_disk_bytes=1 << 30, max_disk_age=7 * 24 * 3600):
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = os.path.join(disk_dir, disk_subdir) if disk_dir else None
+        self.max_disk_bytes = max_disk_bytes
+        self.max_disk_age = max_disk_age
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_evictions": 0}
+
+        if disk_dir and model_version:
+            self._age_out_disk_versions()
+
+    # Results in memory are dropped when the checkpoint changes; those on disk stay until aged out
+    def set_model_version(self, model_version):
+        with self._lock:
+            if model_version == self.model_version:
+                return
+            self.model_version = model_version
+            self._entries.clear()
+            self._bytes = 0
+
+        if self.disk_dir and model_version:
+            self._age_out_disk_versions()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry
+
+        entry = self._disk_get(key)
+        with self._lock:
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["disk_hits"] += 1
+            self._insert(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._insert(key, entry)
+        self._disk_put(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._bytes,
+                        model_version=self.model_version)
+
+    def _insert(self, key, entry):
+        if key in self._entries:
+            self._bytes -= entry_size(self._entries.pop(key))
+        self._entries[key] = entry
+        self._bytes += entry_size(entry)
+
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= entry_size(evicted)
+            self.stats["evictions"] += 1
+
+    def _version_dir(self):
+        return os.path.join(self.disk_dir, self.model_version)
+
+    # Only names a version id could have are deleted, in case disk_dir is shared with anything else
+    def _age_out_disk_versions(self):
+        version_dir = self._version_dir()
+        os.makedirs(version_dir, exist_ok=True)
+        os.utime(version_dir)
+        cutoff = time.time() - self.max_disk_age
+        for entry in os.scandir(self.disk_dir):
+            if entry.path == version_dir or not disk_version_pattern.fullmatch(entry.name):
+                continue
+            try:
+                stale = entry.is_dir(follow_symlinks=False) and entry.stat().st_mtime < cutoff
+            except OSError:
+                continue  # removed by another process meanwhile
+            if stale:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def _disk_get(self, key):
+        if not self.disk_dir or not self.model_version:
+            return None
+        path = os.path.join(self._version_dir(), key + '.pkl')
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        # Refresh mtime so disk eviction is least-recently-used too
+        try:
+            os.utime(path)
+        except OSError:
+            pass  # evicted since it was read
+        return entry
+
+    # Threads of this process and other processes sharing disk_dir write and evict concurrently, so a
+    # file or directory can vanish between listing and use; the disk tier is best-effort throughout
+    def _disk_put(self, key, entry):
+        if not self.disk_dir or not self.model_version:
+            return
+        version_dir = self._version_dir()
+        path = os.path.join(version_dir, key + '.pkl')
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(version_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = []
+        for version in os.scandir(self.disk_dir):
+            if not disk_version_pattern.fullmatch(version.name):
+                continue
+            try:
+                entries = list(os.scandir(version.path)) if version.is_dir(follow_symlinks=False) else []
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.name.endswith('.pkl'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self.stats["disk_evictions"] += 1
@@ -0,0 +1,144 @@
+# DICOM input (needs pydicom). Images come out as windowed 8-bit greyscale, already shrunk toward
+# the model input as they are decoded. Uncompressed pixel data is read in place through a memory map
+# and box-filtered a band of rows at a time, JPEG frames use the decoder's DCT scaling and
+# JPEG 2000 frames a reduced resolution level, so a 4k x 4k 16-bit study never exists in memory
+# at full size. Other transfer syntaxes go through pydicom's pixel_array (and its plugins).
+import io
+import os
+
+import numpy as np
+import pydicom
+from PIL import Image
+from pydicom.encaps import generate_frames
+from pydicom.multival import MultiValue
+from pydicom.uid import JPEG2000, ExplicitVRBigEndian, JPEG2000Lossless, JPEGBaseline8Bit, UID
+
+# Decoded images keep at least this many pixels on the short side, 2x the model input as for
+# JPEG draft decoding in load_image
+min_decode_size = 448
+
+
+# The integer factor an image can shrink by and keep min_size on its short side
+def decimation_factor(rows, columns, min_size=min_decode_size):
+    return max(1, min(rows, columns) // min_size)
+
+
+# Mean over factor x factor blocks of a 2-D array (trailing partial blocks are dropped), computed
+# band_rows output rows at a time so only a band of the source is read and converted at once.
+# prepare, if given, maps each integer band to the values to average.
+def box_downsample(pixels, factor, prepare=None, band_rows=16):
+    rows, columns = pixels.shape[0] // factor, pixels.shape[1] // factor
+    out = np.empty((rows, columns), np.float32)
+    for start in range(0, rows, band_rows):
+        stop = min(rows, start + band_rows)
+        band = np.asarray(pixels[start * factor:stop * factor, :columns * factor])
+        if prepare is not None:
+            band = prepare(band)
+        out[start:stop] = band.astype(np.float32).reshape(stop - start, factor, columns, factor).mean(axis=(1, 3))
+    return out
+
+
+# Native pixel data keeps its value in the low BitsStored bits; mask the rest off, sign-extending
+# signed data. None when every allocated bit is used.
+def stored_bits_mask(ds):
+    bits_stored, bits_allocated = int(ds.get("BitsStored", ds.BitsAllocated)), int(ds.BitsAllocated)
+    if bits_stored >= bits_allocated:
+        return None
+    if ds.get("PixelRepresentation", 0) == 1:
+        shift = 32 - bits_stored
+        return lambda band: (band.astype(np.int32) << shift) >> shift
+    return lambda band: band & ((1 << bits_stored) - 1)
+
+
+def _first(value):
+    return float(value[0] if isinstance(value, MultiValue) else value)
+
+
+# Stored values -> 8-bit display values: Modality LUT (rescale slope/intercept), then the first
+# VOI window in the header (or the image's own range without one), inverted for MONOCHROME1
+def window(ds, values):
+    values = values * float(ds.get("RescaleSlope", 1)) + float(ds.get("RescaleIntercept", 0))
+    if "WindowCenter" in ds and "WindowWidth" in ds and _first(ds.WindowWidth) > 1:
+        center, width = _first(ds.WindowCenter), _first(ds.WindowWidth)
+        scaled = (values - (center - 0.5)) / (width - 1) + 0.5
+    else:
+        low, high = float(values.min()), float(values.max())
+        scaled = (values - low) / (high - low) if high > low else np.zeros_like(values)
+    scaled = np.clip(scaled, 0, 1)
+    if ds.get("PhotometricInterpretation") == "MONOCHROME1":
+        scaled = 1 - scaled
+    return Image.fromarray(np.rint(255 * scaled).astype(np.uint8), 'L')
+
+
+# First frame of native (uncompressed) pixel data as an array over the file or buffer, not a copy
+def native_frame(ds, path=None, buffer=None):
+    bits = int(ds.BitsAllocated)
+    if bits not in (8, 16, 32):
+        raise ValueError(f"Unsupported BitsAllocated {bits}")
+    order = ">" if ds.file_meta.TransferSyntaxUID == ExplicitVRBigEndian else "<"
+    dtype = np.dtype(f"{order}{'i' if ds.get('PixelRepresentation', 0) == 1 else 'u'}{bits // 8}")
+    shape = (int(ds.Rows), int(ds.Columns))
+
+    element = ds.get_item("PixelData", keep_deferred=True)
+    if element.value is None:
+        if path is not None:
+            return np.memmap(path, dtype=dtype, mode="r", offset=element.value_tell, shape=shape)
+        return np.frombuffer(buffer, dtype=dtype, count=shape[0] * shape[1],
+                             offset=element.value_tell).reshape(shape)
+    # Small pixel data is read with the header
+    return np.frombuffer(ds.PixelData, dtype=dtype, count=shape[0] * shape[1]).reshape(shape)
+
+
+def first_encapsulated_frame(ds):
+    return next(generate_frames(ds.PixelData, number_of_frames=int(ds.get("NumberOfFrames", 1))))
+
+
+# First frame as an array, decoded at reduced size where the transfer syntax allows it
+def decode_frame(ds, path=None, buffer=None):
+    transfer_syntax = UID(ds.file_meta.TransferSyntaxUID)
+    if not transfer_syntax.is_compressed and not transfer_syntax.is_deflated:
+        return native_frame(ds, path, buffer), stored_bits_mask(ds)
+
+    if transfer_syntax == JPEGBaseline8Bit:
+        image = Image.open(io.BytesIO(first_encapsulated_frame(ds)))
+        # DCT scaling: the decoder itself shrinks by up to 8x
+        image.draft('L', (min_decode_size, min_decode_size))
+        return np.asarray(image.convert('L')), None
+
+    if transfer_syntax in (JPEG2000Lossless, JPEG2000):
+        image = Image.open(io.BytesIO(first_encapsulated_frame(ds)))
+        # Decode only the resolution levels needed: each level dropped halves both sides
+        image.reduce = int(np.log2(decimation_factor(int(ds.Rows), int(ds.Columns))))
+        image.load()
+        return np.asarray(image), None
+
+    pixels = ds.pixel_array
+    return (pixels[0] if int(ds.get("NumberOfFrames", 1)) > 1 else pixels), None
+
+
+# Open a DICOM file (path or binary file object) as an 8-bit 'L' image with its short side shrunk
+# to between min_decode_size and twice that (unless already smaller). draft=True samples every
+# factor-th row and column of native data instead of averaging blocks: it reads only those rows,
+# but aliases fine detail.
+def read_dicom(fp, draft=False):
+    path = buffer = None
+    if isinstance(fp, (str, os.PathLike)):
+        path = fp
+    else:
+        fp.seek(0)
+        if not hasattr(fp, "getbuffer"):
+            fp = io.BytesIO(fp.read())
+        buffer = fp.getbuffer()
+
+    ds = pydicom.dcmread(path or fp, defer_size="64 KB")
+    if int(ds.get("SamplesPerPixel", 1)) != 1:
+        raise ValueError("Only greyscale (single-sample) DICOM images are supported")
+
+    pixels, prepare = decode_frame(ds, path, buffer)
+    factor = decimation_factor(*pixels.shape)
+    if draft:
+        small = np.asarray(pixels[::factor, ::factor])
+        values = (prepare(small) if prepare else small).astype(np.float32)
+    else:
+        values = box_downsample(pixels, factor, prepare)
+    return window(ds, values)
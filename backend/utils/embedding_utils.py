@@ -0,0 +1,227 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils.model_utils import embedding_dim, format_batch_predictions, head_names
+
+
+def tensors_digest(state_dict, names):
+    digest = hashlib.sha256()
+    for name in names:
+        tensor = state_dict[name].contiguous()
+        digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        digest.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+# Content hash of a checkpoint's backbone weights only, so retrained heads keep the same version;
+# None for a heads-only checkpoint
+def backbone_version(model_path, precision="fp32"):
+    state_dict = torch.load(model_path, map_location="cpu", weights_only=True, mmap=True)
+    names = sorted(name for name in state_dict if name.startswith("backbone."))
+    if not names:
+        return None
+    return f"{tensors_digest(state_dict, names)}-{precision}"
+
+
+# Content hash of a checkpoint's disease heads only (full model or heads-only checkpoint)
+def heads_version(model_path):
+    state_dict = torch.load(model_path, map_location="cpu", weights_only=True, mmap=True)
+    return tensors_digest(state_dict, [f"{name}.{part}" for name in head_names for part in ("weight", "bias")])
+
+
+# Raise unless model_path has the backbone the store's embeddings came from. Only the weight hashes
+# are compared (not the precision suffix); stores or checkpoints without a backbone version pass.
+def check_backbone(store, model_path):
+    stored = (store.meta["backbone_version"] or "").rsplit("-", 1)[0]
+    found = (backbone_version(model_path) or "").rsplit("-", 1)[0]
+    if stored and found and stored != found:
+        raise ValueError(f"{model_path} has backbone {found}, but {store.path} holds embeddings from {stored}")
+
+
+# Append-only store of pooled backbone embeddings: path/embeddings.f16 is a raw (N, dim) float16
+# array read through np.memmap, path/ids.txt holds one id per row and path/meta.json the dim and
+# backbone version. A re-added id points at its newest row.
+# Readers (the default) never modify the files, so they can open the store while scan.py writes to
+# it. writable=True creates the store if needed and appends; writers hold an exclusive lock on
+# path/.lock while repairing the files on open and around every add().
+class EmbeddingStore:
+    def __init__(self, path, backbone_version=None, dim=embedding_dim, writable=False):
+        self.path = path
+        self.writable = writable
+        self._data_path = os.path.join(path, "embeddings.f16")
+        self._ids_path = os.path.join(path, "ids.txt")
+        self._meta_path = os.path.join(path, "meta.json")
+        self._lock_path = os.path.join(path, ".lock")
+        self._lock = threading.Lock()
+        self._memmap = None
+        self.ids = []
+        self.index = {}
+
+        if not writable and not os.path.exists(self._meta_path):
+            raise FileNotFoundError(f"{path} is not an embedding store (write one with scan.py --embeddings)")
+        if writable:
+            os.makedirs(path, exist_ok=True)
+
+        with self._file_lock():
+            if os.path.exists(self._meta_path):
+                with open(self._meta_path) as f:
+                    self.meta = json.load(f)
+                if backbone_version is not None and self.meta["backbone_version"] != backbone_version:
+                    raise ValueError(f"{path} holds embeddings from backbone {self.meta['backbone_version']}, "
+                                     f"not {backbone_version}")
+            else:
+                self.meta = {"dim": dim, "dtype": "float16", "backbone_version": backbone_version}
+                with open(self._meta_path, "w") as f:
+                    json.dump(self.meta, f)
+
+            self.dim = self.meta["dim"]
+            self._row_bytes = self.dim * 2
+            if writable:
+                self._repair()
+            self.refresh()
+
+    # Exclusive lock shared by every writer of the store (a no-op for readers)
+    @contextmanager
+    def _file_lock(self):
+        if not self.writable:
+            yield
+            return
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # Rows count only once both the vector and its id were written, so the leftovers of an interrupted
+    # add() are cut off here rather than misaligning every later row. Called with the file lock held.
+    def _repair(self):
+        lines = []
+        if os.path.exists(self._ids_path):
+            with open(self._ids_path, encoding="utf-8") as f:
+                lines = f.readlines()
+        data_bytes = os.path.getsize(self._data_path) if os.path.exists(self._data_path) else 0
+        complete = len(lines) - (1 if lines and not lines[-1].endswith("\n") else 0)
+        rows = min(complete, data_bytes // self._row_bytes)
+
+        with open(self._data_path, "ab") as f:
+            if data_bytes != rows * self._row_bytes:
+                f.truncate(rows * self._row_bytes)
+        if len(lines) != rows:
+            with open(self._ids_path, "w", encoding="utf-8") as f:
+                f.writelines(lines[:rows])
+
+    # Pick up rows appended (by another process, or before this store was opened) since the last
+    # call. Read-only: a row counts once its vector and its id are both complete, so rows still being
+    # written are left for a later refresh.
+    def refresh(self):
+        data_bytes = os.path.getsize(self._data_path) if os.path.exists(self._data_path) else 0
+        if data_bytes // self._row_bytes == len(self.ids):
+            return 0
+        with open(self._ids_path, encoding="utf-8") as f:
+            lines = f.readlines()
+        rows = min(len(lines), data_bytes // self._row_bytes)
+        new_ids = []
+        for line in lines[len(self.ids):rows]:
+            if not line.endswith("\n"):
+                break
+            new_ids.append(line[:-1])
+        with self._lock:
+            for item_id in new_ids:
+                self.index[item_id] = len(self.ids)
+                self.ids.append(item_id)
+            self._memmap = None
+        return len(new_ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, item_id):
+        return item_id in self.index
+
+    def add(self, ids, features):
+        features = np.ascontiguousarray(features, dtype=np.float16)
+        if features.shape != (len(ids), self.dim):
+            raise ValueError(f"Expected features of shape ({len(ids)}, {self.dim}), got {features.shape}")
+        if any("\n" in item_id for item_id in ids):
+            raise ValueError("Ids must not contain newlines")
+
+        if not self.writable:
+            raise RuntimeError(f"{self.path} was opened read-only")
+
+        with self._file_lock():
+            # Rows another writer appended come first
+            self.refresh()
+            with self._lock:
+                with open(self._data_path, "ab") as f:
+                    f.write(features.tobytes())
+                with open(self._ids_path, "a", encoding="utf-8") as f:
+                    f.writelines(f"{item_id}\n" for item_id in ids)
+                for item_id in ids:
+                    self.index[item_id] = len(self.ids)
+                    self.ids.append(item_id)
+                self._memmap = None
+
+    # (N, dim) float16 view of every stored row, including superseded ones
+    def features(self):
+        with self._lock:
+            if self._memmap is None:
+                self._memmap = np.memmap(self._data_path, dtype=np.float16, mode="r", shape=(len(self.ids), self.dim)) \
+                    if self.ids else np.zeros((0, self.dim), np.float16)
+            return self._memmap
+
+    def get(self, item_id):
+        return np.asarray(self.features()[self.index[item_id]], dtype=np.float32)
+
+    # (ids, float32 array) chunks over the newest row of every id
+    def iter_chunks(self, chunk_size=65536):
+        features = self.features()
+        rows = sorted(self.index.values())
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            contiguous = chunk[-1] - chunk[0] + 1 == len(chunk)
+            block = features[chunk[0]:chunk[-1] + 1] if contiguous else features[chunk]
+            yield [self.ids[row] for row in chunk], np.asarray(block, dtype=np.float32)
+
+
+    # (rows, float32 array) chunks over every row from start to stop (default: the end), superseded
+    # ones included
+    def iter_rows(self, start=0, chunk_size=65536, stop=None):
+        features = self.features()
+        stop = len(features) if stop is None else min(stop, len(features))
+        for first in range(start, stop, chunk_size):
+            block = features[first:min(first + chunk_size, stop)]
+            yield np.arange(first, first + len(block)), np.asarray(block, dtype=np.float32)
+
+    # Whether row is the newest one of its id
+    def is_current(self, row):
+        return self.index.get(self.ids[row]) == row
+
+
+# The three disease heads from a checkpoint (a full model state dict or just the heads)
+def load_heads(model_path):
+    state_dict = torch.load(model_path, map_location="cpu", weights_only=True)
+    heads = []
+    for name in head_names:
+        weight, bias = state_dict[f"{name}.weight"], state_dict[f"{name}.bias"]
+        head = nn.Linear(weight.shape[1], weight.shape[0])
+        head.load_state_dict({"weight": weight, "bias": bias})
+        heads.append(head.eval())
+    return heads
+
+
+# (id, prediction) for every stored embedding, scored by the given heads; no backbone pass
+def rescore(store, heads, thresholds=None, chunk_size=65536):
+    for ids, features in store.iter_chunks(chunk_size):
+        with torch.no_grad():
+            features = torch.from_numpy(features)
+            outputs = [head(features) for head in heads]
+        yield from zip(ids, format_batch_predictions(outputs, thresholds))
@@ -0,0 +1,24 @@
+import os
+import threading
+
+
+# Starts an object's background threads on first use in each process. Threads do not survive
+# fork, so an object built before forking (e.g. by a gunicorn master preloading the app) has none
+# in the serving process until ensure_started() runs start() there; start() runs once per process.
+class PerProcessThreads:
+    def __init__(self, start):
+        self._start = start
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+                self._pid = os.getpid()
+
+    # Whether this process started the threads, i.e. whether there are any to stop
+    def running(self):
+        return self._pid == os.getpid()
@@ -0,0 +1,205 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from utils.cache_utils import encode_image, image_formats
+from utils.fork_utils import PerProcessThreads
+from utils.model_utils import Explanation, diseases, explain_modes
+
+logger = logging.getLogger("respirascan.jobs")
+
+
+class QueueFull(RuntimeError):
+    pass
+
+
+# One explanation request; heatmaps ({disease: bytes encoded in heatmap_format}) and cams
+# ({disease: uint8 activation-grid map}) fill in as each one finishes. model_version records
+# which checkpoint produced them.
+class ExplanationJob:
+    def __init__(self, image, names, explain_mode, callback=None, heatmap_format="png", model=None,
+                 model_version=None):
+        self.id = uuid.uuid4().hex
+        self.image = image
+        self.model = model
+        self.model_version = model_version
+        self.names = list(names)
+        self.explain_mode = explain_mode
+        self.callback = callback
+        self.heatmap_format = heatmap_format
+
+        self.status = "queued"  # queued, running, done, failed or cancelled
+        self.predictions = None
+        self.heatmaps = {}
+        self.cams = {}
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+        self.cancel_requested = False
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def info(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "diseases": self.names,
+            "completed": list(self.heatmaps),
+            "heatmap_format": self.heatmap_format,
+            "model_version": self.model_version,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+# Heatmaps produced by a small pool of worker threads, off the prediction path.
+# At most max_pending jobs wait or run at once (submit raises QueueFull beyond that),
+# and the last max_finished finished jobs stay available for polling.
+# Jobs run on the queue's model unless submitted with their own (e.g. the version a model registry
+# served the request with), so queued jobs finish on the checkpoint they were submitted for.
+class ExplanationQueue:
+    def __init__(self, model=None, workers=1, max_pending=32, max_finished=256, explain_mode="gradcam",
+                 heatmap_format="png"):
+        self.model = model
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.explain_mode = explain_mode
+        self.heatmap_format = heatmap_format
+
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._threads = []
+        self._workers = PerProcessThreads(self._start)
+        self._closed = False
+
+    def _start(self):
+        self._queue = queue.Queue()
+        self._threads = [threading.Thread(target=self._run, name=f"explainer-{i}", daemon=True)
+                         for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    # names: diseases to explain (default all); heatmap_format: a key of image_formats;
+    # callback(job) runs on the worker after a job succeeds, before it is marked done
+    def submit(self, image, names=None, explain_mode=None, callback=None, heatmap_format=None, model=None,
+               model_version=None):
+        if self._closed:
+            raise RuntimeError("ExplanationQueue is closed")
+        model = model if model is not None else self.model
+        if model is None:
+            raise ValueError("No model to explain with")
+        names = diseases if names is None else names
+        explain_mode = explain_mode or self.explain_mode
+        heatmap_format = heatmap_format or self.heatmap_format
+        unknown = set(names) - set(diseases)
+        if unknown:
+            raise ValueError(f"Unknown diseases: {', '.join(sorted(unknown))}")
+        if explain_mode not in explain_modes:
+            raise ValueError(f"explain_mode must be one of {explain_modes}, got {explain_mode!r}")
+        if heatmap_format not in image_formats:
+            raise ValueError(f"heatmap_format must be one of {tuple(image_formats)}, got {heatmap_format!r}")
+
+        self._workers.ensure_started()
+        job = ExplanationJob(image, names, explain_mode, callback, heatmap_format, model, model_version)
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFull(f"{self._pending} explanations already pending")
+            self._pending += 1
+            self._jobs[job.id] = job
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    # Queued jobs are dropped at once; running ones stop before their next heatmap
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.done():
+                return False
+            job.cancel_requested = True
+            if job.status == "queued":
+                self._finish(job, "cancelled")
+        return True
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in ("queued", "running", "done", "failed", "cancelled")}
+
+    def close(self):
+        self._closed = True
+        if self._workers.running():
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+
+    # Called with self._lock held
+    def _finish(self, job, status, error=None):
+        job.status = status
+        job.error = error
+        job.finished = time.time()
+        job.image = None
+        job.model = None
+        self._pending -= 1
+        job._done.set()
+
+        self._jobs.move_to_end(job.id)
+        finished = [job_id for job_id, other in self._jobs.items() if other.done()]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            with self._lock:
+                if job.done():
+                    continue
+                job.status = "running"
+                job.started = time.time()
+
+            status, error = "done", None
+            try:
+                with Explanation(job.image, job.model, job.explain_mode) as explanation:
+                    job.predictions = explanation.predictions
+                    image_format, quality = image_formats[job.heatmap_format]
+                    for name in job.names:
+                        if job.cancel_requested:
+                            status = "cancelled"
+                            break
+                        heatmap = explanation.heatmap(name)
+                        job.cams[name] = explanation.cams([name])[name]
+                        job.heatmaps[name] = encode_image(heatmap, image_format, quality)
+            except Exception as e:
+                logger.exception("explanation job %s failed", job.id)
+                status, error = "failed", str(e)
+
+            if job.callback is not None and status == "done":
+                try:
+                    job.callback(job)
+                except Exception:
+                    logger.exception("callback of explanation job %s failed", job.id)
+
+            with self._lock:
+                self._finish(job, status, error)
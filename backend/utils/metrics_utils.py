@@ -0,0 +1,152 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Off unless RESPIRASCAN_METRICS=1 or set_enabled(True); timed() is then a shared no-op context
+enabled = os.environ.get("RESPIRASCAN_METRICS", "0") == "1"
+
+# torch.profiler supports one trace per process; _trace.active marks the thread recording it
+_profile_lock = threading.Lock()
+_trace = threading.local()
+
+logger = logging.getLogger("respirascan.timing")
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def set_enabled(value=True):
+    global enabled
+    enabled = value
+
+
+class Histogram:
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Per-stage latency histograms (decode, preprocess, forward, gradcam_backward, overlay, render, ...)
+class StageMetrics:
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+
+    def summary(self):
+        with self._lock:
+            return {
+                stage: {"count": h.count, "sum": h.sum, "mean": h.sum / h.count if h.count else 0.0}
+                for stage, h in self.histograms.items()
+            }
+
+    # Prometheus text exposition format
+    def prometheus_text(self, name="respirascan_stage_seconds"):
+        lines = [
+            f"# HELP {name} Time spent per inference pipeline stage.",
+            f"# TYPE {name} histogram",
+        ]
+        with self._lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    # Replace path with the Prometheus text in one rename, for node_exporter's textfile collector
+    # (which only reads *.prom files) or any scraper that cannot reach the process
+    def write_prometheus(self, path):
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(temporary, path)
+
+
+metrics = StageMetrics()
+
+
+class _StageTimer:
+    __slots__ = ("stage", "start", "record")
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.record = None
+
+    def __enter__(self):
+        if getattr(_trace, "active", False):
+            import torch
+            self.record = torch.profiler.record_function(self.stage)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        if self.record is not None:
+            self.record.__exit__(*exc)
+        metrics.observe(self.stage, seconds)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({"event": "stage_timing", "stage": self.stage, "seconds": round(seconds, 6)}))
+        return False
+
+
+_disabled = nullcontext()
+
+
+# with timed("forward"): ...
+def timed(stage):
+    if not enabled and not getattr(_trace, "active", False):
+        return _disabled
+    return _StageTimer(stage)
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+# Record everything inside the block with torch.profiler and write a Chrome trace to path.
+# Stages wrapped in timed() on this thread show up as named ranges in the trace. Overlapping
+# profilers crash the interpreter, so this raises ProfilerBusy while another trace is running, or
+# with blocking=True waits for it to finish.
+@contextmanager
+def profile_trace(path, blocking=False):
+    import torch
+
+    if not _profile_lock.acquire(blocking=blocking):
+        raise ProfilerBusy("Another request is being profiled")
+    try:
+        _trace.active = True
+        try:
+            with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                        record_shapes=True) as profiler:
+                yield profiler
+        finally:
+            _trace.active = False
+        profiler.export_chrome_trace(path)
+    finally:
+        _profile_lock.release()
@@ -1,9 +1,17 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torchvision import models, transforms
 from PIL import Image
 import numpy as np
 import cv2
+import hashlib
+import os
+import threading
+import warnings
+from itertools import islice
+
+from utils.metrics_utils import timed
 
 # Device
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -29,110 +37,553 @@ class MultiTaskDenseNet(nn.Module):
         )
 
 # Load model
-def load_model(model_path):
-    model = MultiTaskDenseNet().to(device)
-    model.load_state_dict(torch.load(model_path, map_location=device))
+# precision: "fp32", "bf16" (reduced-precision weights and activations) or
+# "int8" (CPU only; calibrated static backbone + dynamic heads, see quantize_model)
+# backend: "torch", or "onnx" to run an exported .onnx file on ONNX Runtime's CPU provider, with the
+# intra/inter-op threads of runtime_config(); precision, calibration_images, optimize and mmap are torch-only
+# optimize: None, "torchscript" (frozen channels_last TorchScript, cached on disk) or "compile" (torch.compile)
+# warmup: forward passes to run before returning, so the first request is not a cold one
+# mmap: map the checkpoint instead of reading it; fp32 eager weights then stay backed by the
+# OS page cache and are shared by every process that loads the same file
+def load_model(model_path, precision="fp32", calibration_images=None, backend="torch",
+               optimize=None, cache_dir=None, warmup=0, mmap=False):
+    if precision not in ("fp32", "bf16", "int8"):
+        raise ValueError(f"Unsupported precision: {precision}")
+    if backend not in ("torch", "onnx"):
+        raise ValueError(f"Unsupported backend: {backend}")
+    if optimize not in (None, "torchscript", "compile"):
+        raise ValueError(f"Unsupported optimization: {optimize}")
+
+    if backend == "onnx":
+        from utils.onnx_utils import OnnxModel
+        from utils.runtime_utils import runtime_config
+
+        torch_only = {"precision": precision != "fp32", "calibration_images": calibration_images is not None,
+                      "optimize": optimize is not None, "mmap": mmap}
+        ignored = [name for name, given in torch_only.items() if given]
+        if ignored:
+            raise ValueError(f"Not supported by the onnx backend, which runs the exported fp32 graph: "
+                             f"{', '.join(ignored)}")
+        config = runtime_config()
+        model = OnnxModel(model_path, intra_op_threads=config.get("intra_op_threads"),
+                          inter_op_threads=config.get("inter_op_threads"))
+        model.input_device = torch.device("cpu")
+        warmup_model(model, warmup)
+        return model
+
+    if mmap:
+        state_dict = torch.load(model_path, map_location=device, mmap=True, weights_only=True)
+        # Build on the meta device so no throwaway weights are allocated, then adopt the mapped tensors
+        with torch.device("meta"):
+            model = MultiTaskDenseNet()
+        model.load_state_dict(state_dict, assign=True)
+    else:
+        model = MultiTaskDenseNet().to(device)
+        model.load_state_dict(torch.load(model_path, map_location=device))
     model.eval()
+
+    input_dtype = torch.float32
+    input_device = device
+    if precision == "bf16":
+        model = model.to(torch.bfloat16)
+        input_dtype = torch.bfloat16
+    elif precision == "int8":
+        model = quantize_model(model.cpu(), calibration_images)
+        input_device = torch.device("cpu")
+
+    if optimize:
+        calibration = calibration_version(calibration_images) if precision == "int8" else None
+        model = optimize_model(model, model_path, optimize, precision, input_dtype, input_device, cache_dir,
+                               calibration)
+
+    model.precision = precision
+    model.optimized = optimize
+    model.input_dtype = input_dtype
+    model.input_device = input_device
+    model.input_memory_format = torch.channels_last if optimize else torch.contiguous_format
+
+    warmup_model(model, warmup)
     return model
 
-# Preprocessing
+# Frozen TorchScript or torch.compile version of the model in channels_last memory format.
+# TorchScript artifacts are cached under cache_dir (default: <checkpoint dir>/.compiled), keyed on
+# the checkpoint contents, precision, torch version and, for int8, calibration (a calibration_version).
+def optimize_model(model, model_path, optimize, precision, input_dtype, input_device, cache_dir=None,
+                   calibration=None):
+    model = model.to(memory_format=torch.channels_last)
+
+    if optimize == "compile":
+        return torch.compile(model)
+
+    from utils.cache_utils import checkpoint_version
+
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(model_path)), '.compiled')
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    variant = precision if calibration is None else f"{precision}-calibration{calibration}"
+    cache_path = os.path.join(
+        cache_dir, f"{name}-{checkpoint_version(model_path)}-{variant}-torch{torch.__version__}-{input_device.type}.ts"
+    )
+
+    if os.path.exists(cache_path):
+        frozen = torch.jit.load(cache_path, map_location=input_device)
+    else:
+        example = torch.zeros(1, 3, 224, 224, dtype=input_dtype, device=input_device)
+        example = example.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad():
+            frozen = torch.jit.freeze(torch.jit.trace(model, example))
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        torch.jit.save(frozen, tmp_path)
+        os.replace(tmp_path, cache_path)
+
+    # Backend-specific fusions (e.g. prepacked oneDNN weights) cannot be serialized, so run them after loading
+    return torch.jit.optimize_for_inference(frozen)
+
+def warmup_model(model, iterations, batch_size=1):
+    if iterations <= 0:
+        return
+    example = to_model_input(torch.zeros(batch_size, 3, 224, 224), model)
+    with torch.no_grad():
+        for _ in range(iterations):
+            model(example)
+
+# Device, dtype and memory format the model expects its input in
+def to_model_input(tensor, model):
+    tensor = tensor.to(getattr(model, 'input_device', device), dtype=getattr(model, 'input_dtype', torch.float32))
+    return tensor.contiguous(memory_format=getattr(model, 'input_memory_format', torch.contiguous_format))
+
+image_extensions = ('.jpg', '.jpeg', '.png', '.dcm')
+
+def list_images(folder):
+    return sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(folder)
+        for name in names
+        if name.lower().endswith(image_extensions)
+    )
+
+# Post-training static int8 quantization of the backbone, calibrated on
+# calibration_images (a folder or a list of PIL images), plus dynamic int8
+# quantization of the three nn.Linear heads
+# Content hash of the images quantize_model would calibrate with (a folder or PIL images)
+def calibration_version(calibration_images=None, max_calibration_images=64):
+    digest = hashlib.sha256()
+    if isinstance(calibration_images, str):
+        for path in list_images(calibration_images)[:max_calibration_images]:
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    else:
+        for image in calibration_images or []:
+            digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+            digest.update(image.tobytes())
+    return digest.hexdigest()[:16]
+
+def quantize_model(model, calibration_images=None, max_calibration_images=64):
+    from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    if isinstance(calibration_images, str):
+        calibration_images = [load_image(path) for path in list_images(calibration_images)[:max_calibration_images]]
+
+    if calibration_images:
+        qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+        example_inputs = (torch.zeros(1, 3, 224, 224),)
+        backbone = prepare_fx(model.backbone, qconfig_mapping, example_inputs)
+
+        with torch.no_grad():
+            for start in range(0, len(calibration_images), 8):
+                chunk = calibration_images[start:start + 8]
+                backbone(torch.stack([fast_preprocess(image) for image in chunk]))
+
+        model.backbone = convert_fx(backbone)
+    else:
+        warnings.warn("No calibration images given; only the heads are quantized to int8")
+
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+# Preprocessing (reference torchvision pipeline)
 preprocess = transforms.Compose([
     transforms.Resize((224, 224)),
     transforms.ToTensor(),
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
 ])
 
+# ToTensor's /255 and Normalize fused into one uint8 -> float32 lookup per channel,
+# computed with the same float32 operations so results are bit-identical
+normalize_mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+normalize_std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+normalize_lut = (np.arange(256, dtype=np.float32)[None, :] / np.float32(255) - normalize_mean[:, None]) / normalize_std[:, None]
+channel_index = np.arange(3)[:, None, None]
+
+# Fast equivalent of preprocess. Greyscale images are resized as one channel and
+# expanded to three afterwards, which gives the same result as converting to RGB first.
+def fast_preprocess(image):
+    with timed("preprocess"):
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+
+        pixels = np.asarray(image.resize((224, 224), Image.BILINEAR))
+        if pixels.ndim == 2:
+            normalized = normalize_lut[:, pixels]
+        else:
+            normalized = normalize_lut[channel_index, pixels.transpose(2, 0, 1)]
+        return torch.from_numpy(normalized)
+
+# DICOM files carry "DICM" after a 128-byte preamble
+def is_dicom(fp):
+    if isinstance(fp, (str, os.PathLike)):
+        with open(fp, 'rb') as f:
+            return is_dicom(f)
+    position = fp.tell()
+    header = fp.read(132)
+    fp.seek(position)
+    return header[128:132] == b'DICM'
+
+# Open an image as 'L' or 'RGB' without converting greyscale X-rays to RGB.
+# draft=True lets the JPEG decoder downscale by up to 8x while decoding (keeping at least
+# 2x the model input size); this is much cheaper for large X-rays but no longer bit-identical.
+# DICOM files (needs pydicom) are windowed to 'L' and shrunk while decoding, see dicom_utils.
+def load_image(fp, draft=False):
+    with timed("decode"):
+        if is_dicom(fp):
+            from utils.dicom_utils import read_dicom
+            return read_dicom(fp, draft)
+
+        image = Image.open(fp)
+        if draft and image.format == 'JPEG' and image.mode in ('L', 'RGB'):
+            image.draft(image.mode, (448, 448))
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        image.load()
+        return image
+
 # Prediction
-def predict_image(image, model):
-    input_tensor = preprocess(image).unsqueeze(0).to(device)
-    with torch.no_grad():
-        pneumonia_out, tb_out, fibrosis_out = model(input_tensor)
-        softmax = nn.Softmax(dim=1)
-
-        pneumonia_probs = softmax(pneumonia_out)
-        tb_probs = softmax(tb_out)
-        fibrosis_probs = softmax(fibrosis_out)
-
-        pneumonia_pred = torch.argmax(pneumonia_probs, dim=1).item()
-        tb_pred = torch.argmax(tb_probs, dim=1).item()
-        fibrosis_pred = torch.argmax(fibrosis_probs, dim=1).item()
-
-        label_map = {0: "Normal", 1: "Disease"}
-
-        return {
-            "Pneumonia": {
-                "label": label_map[pneumonia_pred],
-                "confidence": round(pneumonia_probs[0][pneumonia_pred].item(), 3)
-            },
-            "Tuberculosis": {
-                "label": label_map[tb_pred],
-                "confidence": round(tb_probs[0][tb_pred].item(), 3)
-            },
-            "Fibrosis": {
-                "label": label_map[fibrosis_pred],
-                "confidence": round(fibrosis_probs[0][fibrosis_pred].item(), 3)
-            }
+label_map = {0: "Normal", 1: "Disease"}
+diseases = ['Pneumonia', 'Tuberculosis', 'Fibrosis']
+
+# Label/confidence dicts for every sample of a batch of head outputs. thresholds ({disease: p})
+# label a head Disease once its Disease probability reaches p, instead of taking the argmax.
+def format_batch_predictions(outputs, thresholds=None):
+    probs = torch.stack([F.softmax(output.detach().float(), dim=1) for output in outputs], dim=1)
+    preds = torch.argmax(probs, dim=2)
+    if thresholds:
+        cutoffs = torch.tensor([thresholds.get(disease, 0.5) for disease in diseases])
+        overridden = torch.tensor([disease in thresholds for disease in diseases])
+        preds = torch.where(overridden, (probs[:, :, 1] >= cutoffs).long(), preds)
+    confidences = torch.gather(probs, 2, preds.unsqueeze(2)).squeeze(2)
+
+    # One transfer per batch instead of an .item() per sample and head
+    preds = preds.cpu().tolist()
+    confidences = confidences.cpu().tolist()
+
+    return [
+        {
+            disease: {"label": label_map[pred], "confidence": round(confidence, 3)}
+            for disease, pred, confidence in zip(diseases, sample_preds, sample_confidences)
         }
+        for sample_preds, sample_confidences in zip(preds, confidences)
+    ]
+
+def format_predictions(outputs):
+    return format_batch_predictions(outputs)[0]
+
+def predict_image(image, model):
+    input_tensor = to_model_input(fast_preprocess(image).unsqueeze(0), model)
+    with torch.no_grad(), timed("forward"):
+        return format_predictions(model(input_tensor))
+
+# Batched prediction over PIL images, preprocessed (3, 224, 224) tensors or an (N, 3, 224, 224) tensor.
+# return_features also returns the pooled backbone embeddings as an (N, 1024) float32 array.
+def predict_batch(images, model, batch_size=8, return_features=False):
+    if return_features:
+        check_embeddable(model)
+
+    if torch.is_tensor(images):
+        chunks = images.split(batch_size)
+    else:
+        images = iter(images)
+        chunks = iter(lambda: list(islice(images, batch_size)), [])
+
+    results = []
+    features = []
+    for chunk in chunks:
+        if not torch.is_tensor(chunk):
+            chunk = torch.stack([item if torch.is_tensor(item) else fast_preprocess(item) for item in chunk])
+
+        with torch.no_grad(), timed("forward"):
+            if return_features:
+                pooled, outputs = forward_pooled(model, to_model_input(chunk, model))
+                features.append(pooled.float().cpu().numpy())
+            else:
+                outputs = model(to_model_input(chunk, model))
+            results.extend(format_batch_predictions(outputs))
+
+    if return_features:
+        return results, np.concatenate(features) if features else np.zeros((0, embedding_dim), np.float32)
+    return results
 
 # Grad-CAM Utility
 class GradCAM:
     def __init__(self, model, target_layer):
         self.model = model
         self.target_layer = target_layer
-        self.gradients = None
-        self.activations = None
+        # Forward hooks run on the calling thread, so per-thread activations let several threads
+        # explain with the same model at once
+        self._local = threading.local()
+        self._handles = []
         self._register_hooks()
 
+    @property
+    def activations(self):
+        return getattr(self._local, 'activations', None)
+
+    @activations.setter
+    def activations(self, value):
+        self._local.activations = value
+
+    # Gradients come from autograd.grad in generate_multi, so only the forward pass is hooked
     def _register_hooks(self):
-        self.target_layer.register_forward_hook(self._forward_hook)
-        self.target_layer.register_backward_hook(self._backward_hook)
+        self._handles = [self.target_layer.register_forward_hook(self._forward_hook)]
+
+    def remove_hooks(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
 
     def _forward_hook(self, module, input, output):
-        self.activations = output
+        # Plain no_grad predictions never hold on to activations
+        if torch.is_grad_enabled():
+            self.activations = output
 
-    def _backward_hook(self, module, grad_input, grad_output):
-        self.gradients = grad_output[0]
+    # Release the graph, activations and parameter grads of the last run
+    def clear(self):
+        self.activations = None
+        self.model.zero_grad(set_to_none=True)
 
-    def generate(self, input_tensor, target_idx, output):
-        self.model.zero_grad()
-        one_hot = torch.zeros_like(output)
-        one_hot[0][target_idx] = 1
-        output.backward(gradient=one_hot, retain_graph=True)
+    # CAMs for several head outputs from one batched autograd call
+    # activations/retain_graph let a caller holding its own forward pass (see Explanation) reuse the graph;
+    # size=None keeps the maps at the activation grid size
+    def generate_multi(self, outputs, target_indices, activations=None, retain_graph=False, size=224):
+        if activations is None:
+            activations = self.activations
+        logits = torch.cat(outputs, dim=1)
+        one_hots = torch.zeros((len(outputs),) + logits.shape, dtype=logits.dtype, device=logits.device)
+        offset = 0
+        for i, (output, target_idx) in enumerate(zip(outputs, target_indices)):
+            one_hots[i, 0, offset + target_idx] = 1
+            offset += output.shape[1]
 
-        gradients = self.gradients[0].detach().cpu().numpy()
-        activations = self.activations[0].detach().cpu().numpy()
-        weights = np.mean(gradients, axis=(1, 2))
-        cam = np.zeros(activations.shape[1:], dtype=np.float32)
+        try:
+            gradients, = torch.autograd.grad(logits, activations, grad_outputs=one_hots,
+                                             is_grads_batched=True, retain_graph=retain_graph)
+        except RuntimeError:
+            # Some builds lack batching rules for the backbone backward; fall back to one grad call per head
+            gradients = torch.stack([
+                torch.autograd.grad(logits, activations, grad_outputs=one_hot, retain_graph=True)[0]
+                for one_hot in one_hots
+            ])
 
-        for i, w in enumerate(weights):
-            cam += w * activations[i]
+        return self._compute_cams(gradients[:, 0], activations[0], size)
 
-        cam = np.maximum(cam, 0)
-        cam = cv2.resize(cam, (224, 224))
-        cam -= cam.min()
-        cam /= cam.max() if cam.max() > 0 else 1
-        return cam
+    # Weighted channel sum for K gradient maps (K, C, H, W) over activations (C, H, W),
+    # upsampled to size x size and scaled to [0, 1] per map
+    def _compute_cams(self, gradients, activations, size=224):
+        gradients = gradients.detach().float()
+        activations = activations.detach().float()
+        weights = gradients.mean(dim=(2, 3))
+        return normalize_cams(torch.einsum('kc,chw->khw', weights, activations), size)
 
-# Apply Grad-CAM to all diseases
-def apply_gradcam(image, model):
-    model.eval()
-    input_tensor = preprocess(image).unsqueeze(0).to(device)
-    target_layer = model.backbone.features.denseblock3.denselayer16.conv2
-    gradcam = GradCAM(model, target_layer)
+# Positive part of K maps (K, h, w), upsampled to size x size (unless size is None) and scaled to
+# [0, 1] per map. Scaling commutes with the upsampling, so maps normalized at the grid size can be
+# upsampled here later with the same result.
+def normalize_cams(cams, size=224):
+    cams = cams.clamp_min(0)
+    if size is not None:
+        cams = F.interpolate(cams.unsqueeze(1), size=(size, size), mode='bilinear', align_corners=False).squeeze(1)
+    cams -= cams.amin(dim=(1, 2), keepdim=True)
+    peak = cams.amax(dim=(1, 2), keepdim=True)
+    cams /= torch.where(peak > 0, peak, torch.ones_like(peak))
+    return cams
+
+# Head attributes of MultiTaskDenseNet, in the order of diseases
+head_names = ['pneumonia_head', 'tb_head', 'fibrosis_head']
+embedding_dim = 1024
+
+def disease_heads(model):
+    return [getattr(model, name) for name in head_names]
+
+# Pooled backbone embedding (the heads' shared input) and the head outputs
+def forward_pooled(model, input_tensor):
+    pooled = model.backbone(input_tensor)
+    return pooled, tuple(head(pooled) for head in disease_heads(model))
+
+def check_embeddable(model):
+    if (not isinstance(model, nn.Module) or isinstance(model, torch.jit.ScriptModule)
+            or getattr(model, 'optimized', None) or not hasattr(model, 'backbone')):
+        raise ValueError("Embeddings need an eager PyTorch model")
+
+# Final DenseNet feature map (after its ReLU) and the head outputs, from one forward pass
+def forward_features(model, input_tensor):
+    features = F.relu(model.backbone.features(input_tensor))
+    pooled = model.backbone.classifier(torch.flatten(F.adaptive_avg_pool2d(features, 1), 1))
+    return features, tuple(head(pooled) for head in disease_heads(model))
+
+# Classic CAM: every head is linear on globally pooled features, so each class's evidence map is
+# its weight row applied to the feature map. Exact, and needs no autograd or backward pass.
+def class_activation_maps(model, features, target_indices, heads=None, size=224):
+    heads = disease_heads(model) if heads is None else heads
+    weights = torch.stack([head.weight[target_idx] for head, target_idx in zip(heads, target_indices)])
+    return normalize_cams(torch.einsum('kc,chw->khw', weights.float(), features[0].float()), size)
+
+# JET colour map as an RGB lookup table, so overlays never leave RGB
+jet_colormap = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), cv2.COLORMAP_JET)[:, 0, ::-1]
+
+# 224x224 RGB base shared by every overlay of one image
+def overlay_base(image):
+    return np.array(image.resize((224, 224)).convert('RGB'))
 
-    outputs = model(input_tensor)
-    diseases = ['Pneumonia', 'Tuberculosis', 'Fibrosis']
-    heatmaps = {}
+# Overlay a uint8 CAM on the overlay base
+def render_overlay(base, cam):
+    heatmap = jet_colormap[cam]
+    return Image.fromarray(cv2.addWeighted(base, 0.6, heatmap, 0.4, 0))
 
-    for i, output in enumerate(outputs):
-        pred_class = torch.argmax(output, dim=1).item()
-        cam = gradcam.generate(input_tensor, pred_class, output)
+def gradcam_target_layer(model):
+    return model.backbone.features.denseblock3.denselayer16.conv2
 
-        heatmap = np.uint8(255 * cam)
-        heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
+_gradcam_lock = threading.Lock()
 
-        original = cv2.cvtColor(np.array(image.resize((224, 224))), cv2.COLOR_RGB2BGR)
-        overlay = cv2.addWeighted(original, 0.6, heatmap, 0.4, 0)
-        heatmaps[diseases[i]] = Image.fromarray(cv2.cvtColor(overlay, cv2.COLOR_BGR2RGB))
+# One explainer per model, reused across requests. Created under a lock: two threads explaining
+# with a new model at once would otherwise each register hooks, and the loser's would stay on the
+# layer for good.
+def get_gradcam(model):
+    gradcam = getattr(model, '_gradcam', None)
+    if gradcam is None:
+        with _gradcam_lock:
+            gradcam = getattr(model, '_gradcam', None)
+            if gradcam is None:
+                gradcam = GradCAM(model, gradcam_target_layer(model))
+                model._gradcam = gradcam
+    return gradcam
 
-    return heatmaps
+# "gradcam": gradient-weighted maps from denseblock3 (one batched backward pass);
+# "cam": class activation maps from the final feature map at forward-only cost
+explain_modes = ("gradcam", "cam")
+
+def check_explainable(model, explain_mode="gradcam"):
+    if explain_mode not in explain_modes:
+        raise ValueError(f"explain_mode must be one of {explain_modes}, got {explain_mode!r}")
+    if (not isinstance(model, nn.Module) or isinstance(model, torch.jit.ScriptModule)
+            or getattr(model, 'optimized', None) or getattr(model, 'precision', 'fp32') == 'int8'):
+        raise ValueError("Heatmaps need an eager fp32 or bf16 PyTorch model")
+
+# Predictions from one forward pass, with each disease's heatmap computed only when asked for.
+# Grad-CAM keeps this pass's autograd graph (CAM its feature map) alive until close().
+# cams() gives the raw maps at the activation grid size (14x14 Grad-CAM, 7x7 CAM) without
+# rendering overlays.
+class Explanation:
+    def __init__(self, image, model, explain_mode="gradcam"):
+        check_explainable(model, explain_mode)
+        model.eval()
+        self.image = image
+        self.model = model
+        self.explain_mode = explain_mode
+        self._heatmaps = {}
+        self._grid_cams = {}
+        self._base = None
+        input_tensor = to_model_input(fast_preprocess(image).unsqueeze(0), model)
+
+        if explain_mode == "cam":
+            with torch.inference_mode(), timed("forward"):
+                self._activations, self._outputs = forward_features(model, input_tensor)
+                self.predictions = format_predictions(self._outputs)
+        else:
+            gradcam = get_gradcam(model)
+            try:
+                with timed("forward"):
+                    self._outputs = model(input_tensor)
+                    self.predictions = format_predictions(self._outputs)
+                # Held here rather than on the shared explainer, so explanations can overlap
+                self._activations = gradcam.activations
+            finally:
+                gradcam.clear()
+
+        self._targets = [torch.argmax(output, dim=1).item() for output in self._outputs]
+
+    # Grid-size maps in [0, 1] for the names not computed yet, in one pass
+    def _compute_grid_cams(self, names):
+        missing = [name for name in names if name not in self._grid_cams]
+        if not missing:
+            return
+        if self._activations is None:
+            raise RuntimeError("Explanation is closed")
+        heads = [diseases.index(name) for name in missing]
+        targets = [self._targets[i] for i in heads]
+
+        if self.explain_mode == "cam":
+            with torch.inference_mode(), timed("cam"):
+                all_heads = disease_heads(self.model)
+                cams = class_activation_maps(self.model, self._activations, targets,
+                                             heads=[all_heads[i] for i in heads], size=None)
+        else:
+            with timed("gradcam_backward"):
+                cams = get_gradcam(self.model).generate_multi([self._outputs[i] for i in heads], targets,
+                                                              activations=self._activations, retain_graph=True,
+                                                              size=None)
+        for name, cam in zip(missing, cams.cpu()):
+            self._grid_cams[name] = cam
+
+    # {disease: uint8 (h, w) map at the activation grid size} for names (default all)
+    def cams(self, names=None):
+        names = diseases if names is None else names
+        self._compute_grid_cams(names)
+        return {name: (255 * self._grid_cams[name]).to(torch.uint8).numpy() for name in names}
+
+    # {disease: heatmap} for names (default all), computing the missing ones in one pass
+    def heatmaps(self, names=None):
+        names = diseases if names is None else names
+        missing = [name for name in names if name not in self._heatmaps]
+
+        if missing:
+            self._compute_grid_cams(missing)
+            with timed("overlay"):
+                cams = normalize_cams(torch.stack([self._grid_cams[name] for name in missing]))
+                cams = (255 * cams).to(torch.uint8).numpy()
+                if self._base is None:
+                    self._base = overlay_base(self.image)
+                for name, cam in zip(missing, cams):
+                    self._heatmaps[name] = render_overlay(self._base, cam)
+
+        return {name: self._heatmaps[name] for name in names}
+
+    def heatmap(self, name):
+        return self.heatmaps([name])[name]
+
+    # Release the graph / feature map and the model; heatmaps already rendered stay available
+    def close(self):
+        self._activations = None
+        self._outputs = None
+        self.model = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+# Apply Grad-CAM (or CAM) to all diseases
+def apply_gradcam(image, model, explain_mode="gradcam"):
+    with Explanation(image, model, explain_mode) as explanation:
+        return explanation.heatmaps()
+
+# Prediction and heatmaps from a single preprocessing step and forward pass
+def analyze_image(image, model, explain=True, explain_mode="gradcam"):
+    if explain:
+        with Explanation(image, model, explain_mode) as explanation:
+            return explanation.predictions, explanation.heatmaps()
+
+    model.eval()
+    input_tensor = to_model_input(fast_preprocess(image).unsqueeze(0), model)
+    with torch.no_grad(), timed("forward"):
+        return format_predictions(model(input_tensor)), None
@@ -0,0 +1,69 @@
+import numpy as np
+import onnxruntime as ort
+
+input_name = "image"
+output_names = ["pneumonia", "tuberculosis", "fibrosis"]
+
+
+# Export MultiTaskDenseNet to ONNX with three named outputs and a dynamic batch axis
+def export_onnx(model, path, opset=17):
+    import torch
+
+    model = model.float().cpu().eval()
+    torch.onnx.export(
+        model,
+        (torch.zeros(1, 3, 224, 224),),
+        path,
+        input_names=[input_name],
+        output_names=output_names,
+        dynamic_axes={name: {0: "batch"} for name in [input_name] + output_names},
+        opset_version=opset,
+        dynamo=False,
+    )
+
+
+# ONNX Runtime CPU model, callable like MultiTaskDenseNet
+class OnnxModel:
+    precision = "fp32"
+
+    def __init__(self, path, intra_op_threads=None, inter_op_threads=None):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads:
+            options.inter_op_num_threads = inter_op_threads
+
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    # (N, 3, 224, 224) float32 array in, tuple of (N, 2) logit arrays out
+    def run(self, batch):
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        return tuple(self.session.run(output_names, {input_name: batch}))
+
+    def __call__(self, input_tensor):
+        if isinstance(input_tensor, np.ndarray):
+            return self.run(input_tensor)
+
+        import torch
+        outputs = self.run(input_tensor.detach().cpu().numpy())
+        return tuple(torch.from_numpy(output) for output in outputs)
+
+    def eval(self):
+        return self
+
+
+# Largest absolute logit difference between the torch model and its ONNX export
+def max_output_difference(model, onnx_model, batch_sizes=(1, 4)):
+    import torch
+
+    worst = 0.0
+    for batch_size in batch_sizes:
+        batch = torch.randn(batch_size, 3, 224, 224)
+        with torch.no_grad():
+            expected = model.float().cpu().eval()(batch)
+        actual = onnx_model.run(batch.numpy())
+        for ref, out in zip(expected, actual):
+            worst = max(worst, float(np.abs(ref.numpy() - out).max()))
+    return worst
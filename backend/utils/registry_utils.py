@@ -0,0 +1,282 @@
+import gc
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from utils.cache_utils import checkpoint_version
+from utils.fork_utils import PerProcessThreads
+
+logger = logging.getLogger("respirascan.registry")
+
+active_filename = "ACTIVE"
+checkpoint_extension = ".pth"
+snapshot_dirname = ".snapshots"
+
+
+# Checkpoints (name -> path) of a registry directory, or the single checkpoint a file path names
+def list_checkpoints(path):
+    if not os.path.isdir(path):
+        return {os.path.splitext(os.path.basename(path))[0]: path}
+    return {name[:-len(checkpoint_extension)]: os.path.join(path, name)
+            for name in sorted(os.listdir(path)) if name.endswith(checkpoint_extension)}
+
+
+# Checkpoint to serve: the one named in <dir>/ACTIVE, else the most recently modified one
+def active_checkpoint(path):
+    checkpoints = list_checkpoints(path)
+    if not checkpoints:
+        raise FileNotFoundError(f"No {checkpoint_extension} checkpoints in {path}")
+    active_path = os.path.join(path, active_filename)
+    if os.path.isdir(path) and os.path.exists(active_path):
+        with open(active_path) as f:
+            name = f.read().strip()
+        if name not in checkpoints:
+            raise FileNotFoundError(f"{active_path} names {name!r}, which is not in {path}")
+        return name, checkpoints[name]
+    return max(checkpoints.items(), key=lambda item: os.path.getmtime(item[1]))
+
+
+# Point <dir>/ACTIVE at a checkpoint; serving processes pick it up at their next refresh
+def set_active(path, name):
+    if name not in list_checkpoints(path):
+        raise ValueError(f"Unknown checkpoint {name!r} in {path}")
+    with tempfile.NamedTemporaryFile("w", dir=path, delete=False) as f:
+        f.write(name + "\n")
+    os.replace(f.name, os.path.join(path, active_filename))
+
+
+def version_id(name, path):
+    return f"{name}-{checkpoint_version(path)}"
+
+
+# Private copy of a checkpoint to memory-map, named by its content hash, in .snapshots/ next to it:
+# a write over the checkpoint (cp instead of a rename) would otherwise change the weights under a
+# mapped model. Processes snapshotting the same contents share one file, and so its pages; only the
+# keep most recently used snapshots are kept. Returns (snapshot path, content hash).
+def snapshot_checkpoint(path, keep=4):
+    name = os.path.splitext(os.path.basename(path))[0]
+    snapshot_dir = os.path.join(os.path.dirname(os.path.abspath(path)), snapshot_dirname)
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    digest = checkpoint_version(path)
+    snapshot = os.path.join(snapshot_dir, f"{name}-{digest}{checkpoint_extension}")
+    if not os.path.exists(snapshot):
+        # Hash what was copied, not what the file held a moment ago
+        copied = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=snapshot_dir, suffix=".tmp", delete=False) as f, open(path, "rb") as src:
+            for block in iter(lambda: src.read(1 << 20), b""):
+                copied.update(block)
+                f.write(block)
+        digest = copied.hexdigest()[:16]
+        snapshot = os.path.join(snapshot_dir, f"{name}-{digest}{checkpoint_extension}")
+        if os.path.exists(snapshot):
+            os.remove(f.name)
+        else:
+            os.replace(f.name, snapshot)
+    os.utime(snapshot)
+
+    snapshots = sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(snapshot_dir)
+                       if entry.name.endswith(checkpoint_extension))
+    for _, stale in snapshots[:-keep]:
+        # Processes still serving it keep their mapping; the file goes once they unmap it
+        os.remove(stale)
+    return snapshot, digest
+
+
+# One loaded checkpoint. resources is whatever the registry's load function returned for it
+# (models, batcher, ...); it is closed and dropped once the version is retired and no request
+# holds a lease on it.
+class ModelVersion:
+    def __init__(self, name, path, version, resources):
+        self.name = name
+        self.path = path
+        self.version = version
+        self.resources = resources
+        self.loaded = time.time()
+        self.load_seconds = None
+        self.retired = False
+        self.leases = 0
+
+    def info(self):
+        return {"name": self.name, "version": self.version, "loaded": self.loaded,
+                "load_seconds": self.load_seconds, "leases": self.leases}
+
+
+# Serves the active checkpoint of path (a registry directory of <name>.pth files plus an ACTIVE
+# file, or a single checkpoint file) and swaps in a new one without stopping: refresh() notices a
+# changed ACTIVE file or checkpoint contents (at most every poll_interval seconds; with watch=True a
+# thread also calls it that often), load(path) builds and warms up the new version in a background
+# thread, and the swap happens under a lock. Requests lease the version they run on, so the old one
+# keeps serving them and is only closed (close(resources)) and freed after the last lease is returned. A version that fails to load is not retried until
+# its checkpoint or the ACTIVE file changes again. Set snapshot=True when load memory-maps the
+# checkpoint: it is then given a snapshot_checkpoint copy instead of the watched file.
+class ModelRegistry:
+    def __init__(self, path, load, close=None, poll_interval=5.0, watch=True, snapshot=False):
+        self.path = path
+        self.load = load
+        self.close = close
+        self.poll_interval = poll_interval
+        self.watch = watch
+        self.snapshot = snapshot
+
+        self._current = None
+        self._loading = None
+        self._failed = None
+        self._error = None
+        self._retired = []
+        self._checked = 0
+        self._watcher = PerProcessThreads(
+            lambda: threading.Thread(target=self._watch, name="model-watcher", daemon=True).start())
+        self._lock = threading.Lock()
+        self._first_load = threading.Event()
+
+    # Load the active checkpoint in this thread (e.g. before gunicorn forks); load overrides the
+    # registry's load function for this version only
+    def load_now(self, load=None):
+        name, path = active_checkpoint(self.path)
+        self._swap(self._build(name, path, version_id(name, path), load or self.load))
+        return self._current
+
+    # Look for a new active checkpoint and start loading it in the background; returns the version
+    # being loaded, if any. Cheap (a few stat calls) and rate-limited, so it can run on every request.
+    def refresh(self, force=False):
+        self._ensure_watching()
+        now = time.monotonic()
+        with self._lock:
+            if self._loading is not None or (not force and now - self._checked < self.poll_interval):
+                return self._loading
+            self._checked = now
+        try:
+            name, path = active_checkpoint(self.path)
+            version = version_id(name, path)
+        except OSError as e:
+            # E.g. a checkpoint being replaced right now; keep serving and look again later. With
+            # nothing loaded yet, current() raises it rather than waiting for a load that never starts.
+            logger.warning("cannot resolve the active checkpoint of %s: %s", self.path, e)
+            with self._lock:
+                if self._current is None and self._loading is None:
+                    self._error = e
+                    self._first_load.set()
+            return None
+
+        with self._lock:
+            if self._loading is not None or version == self._failed or \
+                    (self._current is not None and version == self._current.version):
+                return self._loading
+            self._loading = version
+            if self._current is None:
+                self._first_load.clear()
+        threading.Thread(target=self._load_in_background, args=(name, path, version),
+                         name=f"model-load-{name}", daemon=True).start()
+        return version
+
+    def _ensure_watching(self):
+        if self.watch:
+            self._watcher.ensure_started()
+
+    def _watch(self):
+        while True:
+            time.sleep(max(self.poll_interval, 0.1))
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("checking %s for a new checkpoint failed", self.path)
+
+    def ready(self):
+        return self._current is not None
+
+    # The serving version, waiting for the first one to load; raises the first load's error, or why
+    # no checkpoint could be found
+    def current(self, timeout=None):
+        if self._current is None:
+            self.refresh(force=True)
+            self._first_load.wait(timeout)
+            if self._current is None:
+                raise self._error or TimeoutError("Model is still loading")
+        return self._current
+
+    # with registry.lease() as served: ... runs on served, which stays open until the block exits
+    @contextmanager
+    def lease(self, timeout=None):
+        self.current(timeout)
+        with self._lock:
+            served = self._current
+            served.leases += 1
+        try:
+            yield served
+        finally:
+            self._release(served)
+
+    def status(self):
+        with self._lock:
+            return {
+                "current": self._current.info() if self._current else None,
+                "loading": self._loading,
+                "failed": self._failed,
+                "error": str(self._error) if self._error else None,
+                "draining": [served.info() for served in self._retired],
+            }
+
+    # Every checkpoint available, marking the active and serving ones
+    def versions(self):
+        try:
+            active = active_checkpoint(self.path)[0]
+        except OSError:
+            active = None
+        serving = self._current.name if self._current else None
+        return [{"name": name, "size": os.path.getsize(path), "modified": os.path.getmtime(path),
+                 "active": name == active, "serving": name == serving}
+                for name, path in list_checkpoints(self.path).items()]
+
+    def _build(self, name, path, version, load=None):
+        start = time.perf_counter()
+        if self.snapshot:
+            path, digest = snapshot_checkpoint(path)
+            version = f"{name}-{digest}"
+        served = ModelVersion(name, path, version, (load or self.load)(path))
+        served.load_seconds = time.perf_counter() - start
+        return served
+
+    def _load_in_background(self, name, path, version):
+        try:
+            served = self._build(name, path, version)
+        except Exception as e:
+            logger.exception("loading %s failed; still serving %s", version,
+                             self._current.version if self._current else "nothing")
+            with self._lock:
+                self._loading, self._failed, self._error = None, version, e
+            self._first_load.set()
+            return
+        self._swap(served)
+        logger.info("now serving %s (loaded in %.1f s)", version, served.load_seconds)
+
+    def _swap(self, served):
+        with self._lock:
+            old, self._current = self._current, served
+            self._loading = self._error = None
+            if old is not None:
+                old.retired = True
+                self._retired.append(old)
+        self._first_load.set()
+        if old is not None:
+            self._release(old, lease=False)
+
+    def _release(self, served, lease=True):
+        with self._lock:
+            if lease:
+                served.leases -= 1
+            if not served.retired or served.leases or served not in self._retired:
+                return
+            self._retired.remove(served)
+        if self.close is not None:
+            try:
+                self.close(served.resources)
+            except Exception:
+                logger.exception("closing %s failed", served.version)
+        # Drop the weights now rather than whenever the next collection runs
+        served.resources = None
+        gc.collect()
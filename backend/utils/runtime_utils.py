@@ -0,0 +1,111 @@
+import json
+import os
+import warnings
+
+import cv2
+import torch
+
+# Environment overrides, applied on top of RESPIRASCAN_RUNTIME_PROFILE (written by autotune.py)
+env_settings = {
+    "intra_op_threads": "RESPIRASCAN_INTRA_OP_THREADS",
+    "inter_op_threads": "RESPIRASCAN_INTER_OP_THREADS",
+    "cv2_threads": "RESPIRASCAN_CV2_THREADS",
+    "cpu_affinity": "RESPIRASCAN_CPU_AFFINITY",
+}
+
+
+# "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]
+def parse_cpus(spec):
+    cpus = []
+    for part in str(spec).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+# The index-th of workers equal, contiguous slices of the CPUs this process may use
+def worker_cpus(index, workers, cpus=None):
+    cpus = available_cpus() if cpus is None else cpus
+    per_worker = max(1, len(cpus) // workers)
+    start = (index % workers) * per_worker % len(cpus)
+    return cpus[start:start + per_worker]
+
+
+def load_runtime_profile(path):
+    with open(path) as f:
+        return json.load(f)["best"]
+
+
+# configure_runtime() arguments from the tuned profile and the environment. With several worker
+# processes on one host, unset intra-op threads default to an equal share of the cores.
+def runtime_config(workers=1):
+    config = {}
+    profile_path = os.environ.get("RESPIRASCAN_RUNTIME_PROFILE")
+    if profile_path:
+        profile = load_runtime_profile(profile_path)
+        config.update({key: profile[key] for key in env_settings if profile.get(key) is not None})
+
+    for key, name in env_settings.items():
+        if os.environ.get(name):
+            config[key] = os.environ[name] if key == "cpu_affinity" else int(os.environ[name])
+
+    if isinstance(config.get("cpu_affinity"), str):
+        config["cpu_affinity"] = parse_cpus(config["cpu_affinity"])
+    if workers > 1 and "intra_op_threads" not in config:
+        config["intra_op_threads"] = max(1, len(config.get("cpu_affinity") or available_cpus()) // workers)
+    return config
+
+
+# pid of the process configure_runtime last ran in; a forked child starts out unconfigured
+_configured_pid = None
+
+
+# Whether configure_runtime already ran in this process, e.g. with per-worker settings from
+# gunicorn.conf.py's post_fork, which process-wide defaults must not then overwrite
+def runtime_configured():
+    return _configured_pid == os.getpid()
+
+
+# Apply process-wide CPU settings; None leaves a setting as it is. Call before the first forward
+# pass: torch fixes the inter-op pool once parallel work has started.
+def configure_runtime(intra_op_threads=None, inter_op_threads=None, cv2_threads=None, cpu_affinity=None):
+    global _configured_pid
+    _configured_pid = os.getpid()
+
+    if cpu_affinity is not None:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpu_affinity)
+        else:
+            warnings.warn("CPU affinity is not supported on this platform; ignoring cpu_affinity")
+
+    if intra_op_threads is not None:
+        torch.set_num_threads(intra_op_threads)
+
+    if inter_op_threads is not None and inter_op_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            warnings.warn(f"Could not set inter-op threads to {inter_op_threads}: {e}")
+
+    if cv2_threads is not None:
+        cv2.setNumThreads(cv2_threads)
+
+    return runtime_info()
+
+
+def runtime_info():
+    return {
+        "intra_op_threads": torch.get_num_threads(),
+        "inter_op_threads": torch.get_num_interop_threads(),
+        "cv2_threads": cv2.getNumThreads(),
+        "cpu_affinity": available_cpus(),
+    }
@@ -0,0 +1,160 @@
+import csv
+import glob
+import io
+import json
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.model_utils import diseases, fast_preprocess, image_extensions, list_images, load_image, predict_batch
+
+
+def is_image_name(name):
+    return name.lower().endswith(image_extensions)
+
+
+# Lazily yield (item_id, read) pairs from directories, glob patterns and ZIP archives;
+# read() returns the decoded PIL image
+def iter_inputs(sources, draft=False):
+    for source in sources:
+        if os.path.isdir(source):
+            for path in list_images(source):
+                yield path, lambda path=path: load_image(path, draft)
+        elif zipfile.is_zipfile(source):
+            archive = zipfile.ZipFile(source)
+            for name in sorted(archive.namelist()):
+                if is_image_name(name):
+                    yield f"{source}:{name}", lambda name=name: load_image(io.BytesIO(archive.read(name)), draft)
+        else:
+            for path in sorted(glob.iglob(source, recursive=True)):
+                if os.path.isfile(path) and is_image_name(path):
+                    yield path, lambda path=path: load_image(path, draft)
+
+
+def load_input(item_id, read):
+    try:
+        with read() as image:
+            return item_id, fast_preprocess(image), None
+    except Exception as e:
+        return item_id, None, f"{type(e).__name__}: {e}"
+
+
+def result_row(item_id, prediction=None, error=None):
+    row = {"id": item_id}
+    for disease in diseases:
+        row[f"{disease.lower()}_label"] = prediction[disease]["label"] if prediction else None
+        row[f"{disease.lower()}_confidence"] = prediction[disease]["confidence"] if prediction else None
+    row["error"] = error
+    return row
+
+
+# Appends result rows to a .csv or .jsonl file, flushing after every batch.
+# Rows already in the file count as finished, so an interrupted scan resumes where it stopped. Error
+# rows do not: failed inputs are tried again, and a later row for the same id supersedes the error.
+class ResultWriter:
+    def __init__(self, path):
+        self.path = path
+        self.format = "csv" if path.lower().endswith(".csv") else "jsonl"
+        self.fieldnames = list(result_row(None))
+
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self.finished = self._read_finished() if exists else set()
+
+        self._file = open(path, "a", newline="")
+        if exists and not self._ends_with_newline():
+            # Terminate a row cut short by an interruption; it is not in self.finished and gets rescored
+            self._file.write("\n")
+        if self.format == "csv":
+            self._csv = csv.DictWriter(self._file, fieldnames=self.fieldnames)
+            if not exists:
+                self._csv.writeheader()
+
+    def _ends_with_newline(self):
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) in (b"\n", b"\r")
+
+    def _read_finished(self):
+        finished = set()
+        with open(self.path, newline="") as f:
+            if self.format == "csv":
+                for row in csv.DictReader(f):
+                    # A truncated last row lacks the trailing columns; csv writes no error as ""
+                    if row.get("error") == "":
+                        finished.add(row["id"])
+            else:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                        if row.get("error") is None:
+                            finished.add(row["id"])
+                    except (ValueError, KeyError):
+                        continue
+        return finished
+
+    def write(self, rows):
+        for row in rows:
+            if self.format == "csv":
+                self._csv.writerow(row)
+            else:
+                self._file.write(json.dumps(row) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# Stream inputs through parallel decode + preprocess, batched inference and incremental writes.
+# At most batch_size * prefetch decoded images are held at once, whatever the input size.
+# With an EmbeddingStore, each batch's pooled backbone features are stored before its rows are written.
+def scan(sources, model, output, batch_size=16, workers=4, prefetch=2, draft=False, progress=None,
+         embeddings=None):
+    writer = ResultWriter(output)
+    counts = {"scored": 0, "failed": 0, "skipped": 0}
+    pending = deque()
+    batch = []
+
+    def flush():
+        ids = [item_id for item_id, _ in batch]
+        tensors = [tensor for _, tensor in batch]
+        if embeddings is None:
+            predictions = predict_batch(tensors, model, batch_size=batch_size)
+        else:
+            predictions, features = predict_batch(tensors, model, batch_size=batch_size, return_features=True)
+            embeddings.add(ids, features)
+        writer.write([result_row(item_id, prediction) for item_id, prediction in zip(ids, predictions)])
+        counts["scored"] += len(batch)
+        batch.clear()
+        if progress:
+            progress(counts)
+
+    def drain_one():
+        item_id, tensor, error = pending.popleft().result()
+        if error:
+            writer.write([result_row(item_id, error=error)])
+            counts["failed"] += 1
+        else:
+            batch.append((item_id, tensor))
+            if len(batch) == batch_size:
+                flush()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for item_id, read in iter_inputs(sources, draft):
+                if item_id in writer.finished:
+                    counts["skipped"] += 1
+                    continue
+                writer.finished.add(item_id)
+                pending.append(pool.submit(load_input, item_id, read))
+                if len(pending) >= batch_size * prefetch:
+                    drain_one()
+
+            while pending:
+                drain_one()
+            if batch:
+                flush()
+    finally:
+        writer.close()
+
+    return counts
@@ -0,0 +1,79 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from utils.fork_utils import PerProcessThreads
+from utils.model_utils import fast_preprocess, predict_batch
+
+
+# Groups concurrent prediction requests into one forward pass
+class MicroBatcher:
+    def __init__(self, model, max_batch_size=16, max_wait_ms=10):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = None
+        self._threads = PerProcessThreads(self._start)
+
+    def _start(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    # Queue a preprocessed (3, 224, 224) tensor; the future resolves to its prediction dict
+    def submit(self, input_tensor):
+        if self._closed:
+            raise RuntimeError("MicroBatcher is closed")
+        self._threads.ensure_started()
+        future = Future()
+        self._queue.put((input_tensor, future))
+        return future
+
+    def predict(self, image, timeout=None):
+        return self.submit(fast_preprocess(image)).result(timeout)
+
+    def close(self):
+        self._closed = True
+        if self._threads.running():
+            self._queue.put(None)
+            self._thread.join()
+
+    # Block for the first request, then wait up to max_wait for the batch to fill
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while batch[-1] is not None and len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            stop = batch[-1] is None
+            batch = [(tensor, future) for tensor, future in batch[:-1 if stop else None]
+                     if future.set_running_or_notify_cancel()]
+
+            if batch:
+                inputs, futures = zip(*batch)
+                try:
+                    results = predict_batch(list(inputs), self.model, batch_size=len(inputs))
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+                else:
+                    for future, result in zip(futures, results):
+                        future.set_result(result)
+
+            if stop:
+                return
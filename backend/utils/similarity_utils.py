@@ -0,0 +1,339 @@
+import logging
+import os
+import threading
+
+import numpy as np
+import torch
+
+index_filename = "similarity_index.npz"
+
+logger = logging.getLogger("respirascan.similar")
+
+
+def normalize(features):
+    features = np.asarray(features, dtype=np.float32)
+    return features / np.maximum(np.linalg.norm(features, axis=-1, keepdims=True), 1e-12)
+
+
+# float16 rows gathered from the store as float32; torch converts several times faster than numpy
+def rows_to_float32(features):
+    return torch.from_numpy(np.array(features, dtype=np.float16)).float().numpy()
+
+
+# Indices of the count largest scores, best first
+def top_indices(scores, count):
+    if count < len(scores):
+        candidates = np.argpartition(-scores, count)[:count]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+# array with room for size + extra rows, reallocated by doubling
+def grow(array, size, extra):
+    if size + extra <= len(array):
+        return array
+    grown = np.empty((max(2 * len(array), size + extra, 16),) + array.shape[1:], array.dtype)
+    grown[:size] = array[:size]
+    return grown
+
+
+# Exact cosine similarity against every stored vector, one matmul per query
+class BruteForceIndex:
+    def __init__(self, dim):
+        self.size = 0
+        self._vectors = np.empty((0, dim), np.float32)
+        self._rows = np.empty(0, np.int64)
+
+    def add(self, rows, features):
+        self._vectors = grow(self._vectors, self.size, len(rows))
+        self._rows = grow(self._rows, self.size, len(rows))
+        self._vectors[self.size:self.size + len(rows)] = normalize(features)
+        self._rows[self.size:self.size + len(rows)] = rows
+        self.size += len(rows)
+
+    # (rows, similarities) of the count nearest vectors, best first
+    def search(self, query, count):
+        scores = self._vectors[:self.size] @ query
+        best = top_indices(scores, count)
+        return self._rows[:self.size][best], scores[best]
+
+    def nbytes(self):
+        return self._vectors.nbytes + self._rows.nbytes
+
+
+# Inverted file over PCA-reduced, int8-quantized vectors. For unit vectors x and q with mean m,
+# x.q = (x - m).(q - m) + m.x + m.q - m.m; the first term is approximated in the PCA subspace
+# and m.x is kept per vector, so a vector costs dims + 12 bytes. A query scores only the vectors
+# in the probes lists whose centroids are nearest to it.
+class IVFIndex:
+    def __init__(self, mean, projection, scale, centroids):
+        self.mean = mean
+        self.projection = projection
+        self.scale = scale
+        self.centroids = centroids
+        self._centroid_norms = 0.5 * (centroids ** 2).sum(axis=1)
+
+        lists, dims = len(centroids), projection.shape[1]
+        self.sizes = np.zeros(lists, np.int64)
+        self._codes = [np.empty((0, dims), np.int8) for _ in range(lists)]
+        self._biases = [np.empty(0, np.float32) for _ in range(lists)]
+        self._rows = [np.empty(0, np.int64) for _ in range(lists)]
+
+    # sample: (n, dim) vectors, normalized here; lists defaults to 4 * sqrt(size), within [16, 4096],
+    # for an index expected to hold size vectors (default: the sample size)
+    @classmethod
+    def train(cls, sample, lists=None, size=None, dims=128, iterations=10, seed=0):
+        sample = normalize(sample)
+        rng = np.random.default_rng(seed)
+        mean = sample.mean(axis=0)
+        # In place: the sample is the largest array here
+        centered = sample
+        centered -= mean
+
+        # Leading principal axes of the sample
+        _, eigenvectors = np.linalg.eigh(centered.T @ centered)
+        projection = np.ascontiguousarray(eigenvectors[:, ::-1][:, :dims], dtype=np.float32)
+        reduced = centered @ projection
+        scale = np.maximum(np.quantile(np.abs(reduced), 0.999, axis=0), 1e-6).astype(np.float32) / 127
+
+        lists = lists or int(np.clip(4 * np.sqrt(size or len(sample)), 16, 4096))
+        lists = min(lists, len(sample))
+        centroids = reduced[rng.choice(len(reduced), lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = cls._nearest(reduced, centroids, 0.5 * (centroids ** 2).sum(axis=1))
+            counts = np.bincount(assignment, minlength=lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, reduced)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            # Re-seed empty lists with random vectors
+            centroids[empty] = reduced[rng.choice(len(reduced), int(empty.sum()), replace=False)]
+        return cls(mean.astype(np.float32), projection, scale, centroids.astype(np.float32))
+
+    @staticmethod
+    def _nearest(reduced, centroids, centroid_norms, chunk_size=16384):
+        return np.concatenate([np.argmax(reduced[i:i + chunk_size] @ centroids.T - centroid_norms, axis=1)
+                               for i in range(0, len(reduced), chunk_size)])
+
+    def add(self, rows, features):
+        features = normalize(features)
+        reduced = (features - self.mean) @ self.projection
+        codes = np.clip(np.rint(reduced / self.scale), -127, 127).astype(np.int8)
+        biases = features @ self.mean
+        assignment = self._nearest(reduced, self.centroids, self._centroid_norms)
+
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(len(self.centroids) + 1))
+        for list_id in np.flatnonzero(np.diff(bounds)):
+            members = order[bounds[list_id]:bounds[list_id + 1]]
+            size = self.sizes[list_id]
+            self._codes[list_id] = grow(self._codes[list_id], size, len(members))
+            self._biases[list_id] = grow(self._biases[list_id], size, len(members))
+            self._rows[list_id] = grow(self._rows[list_id], size, len(members))
+            self._codes[list_id][size:size + len(members)] = codes[members]
+            self._biases[list_id][size:size + len(members)] = biases[members]
+            self._rows[list_id][size:size + len(members)] = np.asarray(rows)[members]
+            self.sizes[list_id] += len(members)
+
+    # (rows, approximate similarities) of up to count vectors from the probes nearest lists, best first
+    def search(self, query, count, probes=16):
+        reduced = (query - self.mean) @ self.projection
+        probed = top_indices(reduced @ self.centroids.T - self._centroid_norms, probes)
+        weights = reduced * self.scale
+        offset = float(self.mean @ query - self.mean @ self.mean)
+
+        scores, rows = [], []
+        for list_id in probed:
+            size = self.sizes[list_id]
+            if size:
+                scores.append(self._codes[list_id][:size].astype(np.float32) @ weights
+                              + self._biases[list_id][:size])
+                rows.append(self._rows[list_id][:size])
+        if not scores:
+            return np.empty(0, np.int64), np.empty(0, np.float32)
+        scores, rows = np.concatenate(scores) + offset, np.concatenate(rows)
+        best = top_indices(scores, count)
+        return rows[best], scores[best]
+
+    def nbytes(self):
+        return sum(a.nbytes for arrays in (self._codes, self._biases, self._rows) for a in arrays)
+
+    def save(self, path, **extra):
+        filled = [slice(0, size) for size in self.sizes]
+        np.savez(path, mean=self.mean, projection=self.projection, scale=self.scale, centroids=self.centroids,
+                 sizes=self.sizes,
+                 codes=np.concatenate([codes[part] for codes, part in zip(self._codes, filled)]),
+                 biases=np.concatenate([biases[part] for biases, part in zip(self._biases, filled)]),
+                 rows=np.concatenate([rows[part] for rows, part in zip(self._rows, filled)]),
+                 **extra)
+
+    @classmethod
+    def load(cls, data):
+        index = cls(data["mean"], data["projection"], data["scale"], data["centroids"])
+        bounds = np.concatenate([[0], np.cumsum(data["sizes"])])
+        codes, biases, rows = data["codes"], data["biases"], data["rows"]
+        for list_id in range(len(index.centroids)):
+            part = slice(bounds[list_id], bounds[list_id + 1])
+            index._codes[list_id], index._biases[list_id], index._rows[list_id] = codes[part], biases[part], rows[part]
+        index.sizes = data["sizes"].copy()
+        return index
+
+
+# Nearest stored cases to a query embedding, by cosine similarity of pooled backbone features.
+# Up to brute_force_limit embeddings are searched exactly; past that an IVFIndex is trained on a
+# sample of the store, and retrained once the store has grown retrain_growth times. Training runs
+# without the index lock, so queries keep being answered by the current index meanwhile; rows synced
+# during training are added to the new index before it is swapped in. The float32 brute-force index
+# never holds more than brute_force_limit rows: rows past it are searched by an exact chunked scan of
+# the store until the IVF index covers them. IVF candidates are re-ranked exactly from the store's
+# memory-mapped float16 rows.
+class SimilarityIndex:
+    def __init__(self, store, brute_force_limit=20000, dims=128, probes=16, rerank=256,
+                 retrain_growth=8, train_sample=65536):
+        self.store = store
+        self.brute_force_limit = brute_force_limit
+        self.dims = dims
+        self.probes = probes
+        self.rerank = rerank
+        self.retrain_growth = retrain_growth
+        self.train_sample = train_sample
+        self.path = os.path.join(store.path, index_filename)
+
+        # Rows [0, indexed) are in self._index; rows [indexed, synced) are scanned exactly
+        self.synced = 0
+        self.indexed = 0
+        self.trained_size = 0
+        self._index = BruteForceIndex(store.dim)
+        self._training = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def __len__(self):
+        return self.synced
+
+    @property
+    def kind(self):
+        return "ivf" if isinstance(self._index, IVFIndex) else "brute_force"
+
+    # A saved IVF index is reused when it belongs to this store; rows added since are synced later
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with np.load(self.path) as data:
+            if str(data["backbone_version"]) != str(self.store.meta["backbone_version"]) \
+                    or int(data["synced"]) > len(self.store) or data["projection"].shape[1] != self.dims:
+                return
+            self._index = IVFIndex.load(data)
+            self.synced = self.indexed = int(data["synced"])
+            self.trained_size = int(data["trained_size"])
+
+    def save(self):
+        with self._lock:
+            if self.kind != "ivf":
+                return False
+            temporary = f"{self.path}.{os.getpid()}.tmp.npz"
+            self._index.save(temporary, synced=self.synced, trained_size=self.trained_size,
+                             backbone_version=str(self.store.meta["backbone_version"]))
+            os.replace(temporary, self.path)
+            return True
+
+    # Called with self._lock held
+    def _needs_training(self, total):
+        if self.kind == "brute_force":
+            return total > self.brute_force_limit
+        return total > self.retrain_growth * self.trained_size
+
+    # Train a new IVF index on the first total rows without holding the lock, then catch it up
+    # with the rows synced meanwhile and swap it in
+    def _retrain(self, total):
+        try:
+            rng = np.random.default_rng(0)
+            rows = np.sort(rng.choice(total, min(total, self.train_sample), replace=False))
+            index = IVFIndex.train(rows_to_float32(self.store.features()[rows]), size=total, dims=self.dims)
+            for rows, features in self.store.iter_rows(0, chunk_size=16384, stop=total):
+                index.add(rows, features)
+            with self._lock:
+                for rows, features in self.store.iter_rows(total, stop=self.synced):
+                    index.add(rows, features)
+                self._index, self.indexed, self.trained_size = index, self.synced, total
+        except Exception:
+            logger.exception("training the similarity index on %d embeddings failed", total)
+        finally:
+            with self._lock:
+                self._training = False
+
+    # Index rows added to the store (by this process or, after a refresh, by another); returns how
+    # many. Only incremental adds happen under the lock. When the index needs (re)training,
+    # background=True trains in a thread and returns at once, as the server does on its query path;
+    # otherwise sync waits for the new index (scan.py).
+    def sync(self, background=False):
+        with self._lock:
+            self.store.refresh()
+            total = len(self.store)
+            added = total - self.synced
+            if self.kind == "ivf" or total <= self.brute_force_limit:
+                for rows, features in self.store.iter_rows(self.indexed, stop=total):
+                    self._index.add(rows, features)
+                self.indexed = total
+            self.synced = total
+            retrain = not self._training and self._needs_training(total)
+            if retrain:
+                self._training = True
+
+        if retrain:
+            if background:
+                threading.Thread(target=self._retrain, args=(total,), name="similarity-train", daemon=True).start()
+            else:
+                self._retrain(total)
+        return added
+
+    # (rows, scores) of the k best rows from search(count), an exact search, skipping superseded rows;
+    # asks for more candidates until k are found or all size rows were returned
+    def _current_top(self, search, size, k):
+        count = k
+        while True:
+            rows, scores = search(count)
+            current = [i for i, row in enumerate(rows) if self.store.is_current(row)]
+            if len(current) >= k or count >= size:
+                return rows[current], scores[current]
+            count *= 4
+
+    # Exact search of the rows not in the index yet, a chunk of the store at a time
+    def _scan_unindexed(self, query, k, chunk_size=16384):
+        found_rows, found_scores = [np.empty(0, np.int64)], [np.empty(0, np.float32)]
+        for chunk_rows, features in self.store.iter_rows(self.indexed, chunk_size, stop=self.synced):
+            chunk_scores = normalize(features) @ query
+
+            def search_chunk(count, chunk_rows=chunk_rows, chunk_scores=chunk_scores):
+                best = top_indices(chunk_scores, count)
+                return chunk_rows[best], chunk_scores[best]
+
+            rows, scores = self._current_top(search_chunk, len(chunk_rows), k)
+            found_rows.append(rows)
+            found_scores.append(scores)
+        return np.concatenate(found_rows), np.concatenate(found_scores)
+
+    # [(id, similarity)] of the k most similar stored cases, most similar first; rows superseded
+    # by a newer embedding of the same id are skipped
+    def search(self, query, k=10):
+        query = normalize(query)
+        with self._lock:
+            if self.kind == "brute_force":
+                rows, scores = self._current_top(lambda count: self._index.search(query, count),
+                                                 self._index.size, k)
+            else:
+                rows, _ = self._index.search(query, max(self.rerank, k), self.probes)
+                rows = np.sort(np.array([row for row in rows if self.store.is_current(row)], np.int64))
+                scores = normalize(rows_to_float32(self.store.features()[rows])) @ query
+            if self.indexed < self.synced:
+                unindexed_rows, unindexed_scores = self._scan_unindexed(query, k)
+                rows = np.concatenate([rows, unindexed_rows])
+                scores = np.concatenate([scores, unindexed_scores])
+            best = top_indices(scores, k)
+            return [(self.store.ids[rows[i]], float(scores[i])) for i in best]
+
+    def stats(self):
+        with self._lock:
+            return {"kind": self.kind, "entries": self.synced, "unindexed": self.synced - self.indexed,
+                    "index_mb": self._index.nbytes() / 2 ** 20, "training": self._training}